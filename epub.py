@@ -1,17 +1,35 @@
+from bisect import bisect_right
+import codecs
+from hashlib import md5
+import json
+import mmap
 import os
-from typing import Dict, List, Union, Set, Optional, Generator
+import re
+import sys
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Set, Tuple, Union, Optional, Generator
 from urllib.parse import unquote
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag, NavigableString, Comment, Stylesheet
+from lxml import etree
 import xmltodict
 
 
 class Nav:
-    def __init__(self, tag: Optional[Tag] = None, index: int = 0, text: str = '', src: str = '') -> None:
-        """tag: bs4.element.Tag, if given, `text` and `src` will be ignored"""
+    def __init__(self, tag: Optional[Tag] = None, index: int = 0, text: str = '', src: str = '', level: int = 0) -> None:
+        """
+        tag: bs4.element.Tag, if given, `text` and `src` will be ignored\n
+        epub模式下src是epub内的绝对路径, 可以带#片段; level是在目录树中的深度, 0为最上层
+        """
         self.index = index
+        self.level = level
+        self.parent: Optional[int] = None  # 目录树中上一级的编号
+        self.start: Tuple[int, str] = (0, '')  # 在spine中的起点 (文件编号, 片段id), 片段为空即从文件开头
+        self.end: Tuple[int, str] = (0, '')  # 终点(不含), 即下一个目录项的起点
         if tag is not None:
             self.text: str = tag.find('navlabel').text.strip()
             self.src: str = tag.find('content').get('src')
@@ -75,124 +93,795 @@ class Image:
         return f'Image(src={self.src})'
 
 
+class _Frame:
+    """流式解析时body内每个尚未闭合的标签"""
+    __slots__ = ('name', 'attrs', 'leaf', 'kind', 'preserve', 'pieces')
+
+    def __init__(self, name: str, attrs: Dict[str, str], kind: Optional[str], preserve: bool) -> None:
+        self.name = name
+        self.attrs = attrs
+        self.leaf = True  # 目前为止还没有子标签
+        self.kind = name if name in _StreamExtractor.string_containers else kind  # 直属字符串的类型, None即普通字符串
+        self.preserve = preserve or name in { 'pre', 'textarea' }
+        self.pieces: List[str] = []  # 叶子标签的直属字符串, 等闭合时才知道该怎么输出
+
+
+class _StreamExtractor:
+    """
+    lxml解析器的target, 每读到一个开始/结束标签或一段文本都会回调到这里, 直接生成Text/Image。\n
+    不建树也不递归, 并且当场查重, 不会先生成重复的Text再删掉; 输出与旧引擎(`Epub._dfs`+查重)保持一致。
+    """
+    # bs4会把这些标签里的字符串解析成NavigableString的子类, 旧引擎会输出成"不支持的类型", 这里保持一致(style里的直接跳过)
+    string_containers = { 'style': 'Stylesheet', 'script': 'Script', 'template': 'TemplateString', 'rt': 'RubyTextString', 'rp': 'RubyParenthesisString' }
+    ascii_spaces = '\x20\x0a\x09\x0c\x0d'
+
+    def __init__(self, root: str, ids: Iterable[str] = ()) -> None:
+        self.root = root
+        self.ids = set(ids)  # 目录项指向的id, 在contents里对应位置插入这个id(str)作为标记
+        self.contents: List[Union[Text, Image, str]] = []
+        self._stack: List[_Frame] = []
+        self._data: List[str] = []
+        self._done = False  # body已经结束
+
+    def start(self, tag: str, attrib: Dict[str, str], nsmap=None):
+        self._flush()
+        if self._stack:
+            parent = self._stack[-1]
+            if parent.leaf:  # 有子标签了, 之前攒着的字符串可以输出了
+                parent.leaf = False
+                for piece in parent.pieces:
+                    self._push_string(piece, parent.kind)
+                parent.pieces = []
+            self._mark(attrib)
+            self._stack.append(_Frame(tag, attrib, parent.kind, parent.preserve))
+        elif tag == 'body' and not self._done:
+            self._mark(attrib)
+            self._stack.append(_Frame(tag, attrib, None, False))
+
+    def _mark(self, attrib: Dict[str, str]):
+        if self.ids and attrib.get('id') in self.ids:
+            self.contents.append(attrib['id'])
+
+    def data(self, data: str):
+        if self._stack:
+            self._data.append(data)
+
+    def comment(self, text: str):
+        self._flush()
+
+    def pi(self, target: str, data: Optional[str] = None):
+        self._flush()
+
+    def end(self, tag: str):
+        self._flush()
+        if not self._stack:
+            return
+        frame = self._stack.pop()
+        if not self._stack:
+            self._done = True
+        if not frame.leaf:
+            return
+        if frame.name == 'img':
+            src = frame.attrs.get('src')
+            if src and not src.lower().startswith('http'):
+                self.contents.append(Image(Epub.path_join(self.root, src)))
+            return
+        keep = frame.name not in { 'style', 'link' }
+        if frame.kind is None:
+            strings = [piece.strip() for piece in frame.pieces]
+            strings = [string for string in strings if string]
+            # 只有一段字符串时它和标签本身的文本相同, 旧引擎查重后只会留下标签的那个, 所以干脆不生成
+            if len(strings) > 1 or not keep:
+                for string in strings:
+                    self._push_navigable(string)
+        else:
+            for piece in frame.pieces:
+                self._push_string(piece, frame.kind)
+        if keep:
+            # 相当于bs4的tag.text, 只算和标签自身匹配的那类字符串
+            text = ''.join(frame.pieces).strip() if frame.kind is None or frame.name == frame.kind else ''
+            self.contents.append(Epub.styled_text(frame.name, text, frame.attrs))
+
+    def close(self) -> List[Union[Text, Image, str]]:
+        return self.contents
+
+    def _flush(self):
+        """和bs4一样, 连续的文本攒到下一个标签/注释出现时才算一个字符串"""
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+        frame = self._stack[-1]
+        if not frame.preserve and not data.strip(_StreamExtractor.ascii_spaces):
+            data = '\n' if '\n' in data else ' '  # bs4会把纯空白压缩成一个字符
+        if frame.leaf:
+            frame.pieces.append(data)
+        else:
+            self._push_string(data, frame.kind)
+
+    def _push_string(self, data: str, kind: Optional[str]):
+        if kind is None:
+            data = data.strip()
+            if data:
+                self._push_navigable(data)
+        elif kind != 'style':
+            self.contents.append(Text(f"不支持的类型 <class 'bs4.element.{_StreamExtractor.string_containers[kind]}'> , 值为 {data}。"))
+
+    def _push_navigable(self, text: str):
+        """查重: 紧跟在同样文本的标签后面的字符串不要"""
+        last = self.contents[-1] if self.contents else None
+        if type(last) is Text and last.source is not NavigableString and last.text == text:
+            return
+        self.contents.append(Text(text, source=NavigableString))
+
+
+_txt_heading_numerals = '0123456789０１２３４５６７８９零〇一二三四五六七八九十百千万两'
+_txt_heading_units = '章节節回卷集部篇话話'
+_txt_heading_words = ('序章', '序言', '楔子', '引子', '尾声', '尾聲', '终章', '終章', '后记', '後記', '番外')
+
+
+@lru_cache()
+def txt_heading_pattern(encoding: str) -> 're.Pattern[bytes]':
+    """
+    txt章节标题(第X章/Chapter N/序章等独占一行)的正则, 直接在字节上匹配, 不用先解码整本书。\n
+    中文字符按给定编码编码后逐个转义作为候选, 因为行首是对齐的, 多字节编码下也不会错位。
+    """
+    def chars(s: str) -> bytes:
+        candidates = []
+        for ch in s:
+            try:
+                candidates.append(re.escape(ch.encode(encoding)))
+            except UnicodeEncodeError:  # 比如简体字在Shift-JIS里没有
+                pass
+        return b'(?:' + b'|'.join(candidates) + b')'
+
+    headings = [rb'(?i:chapter)[ \t]*\d+']
+    try:
+        headings.append(re.escape('第'.encode(encoding)) + chars(_txt_heading_numerals) + b'+' + chars(_txt_heading_units))
+    except UnicodeEncodeError:
+        pass
+    for word in _txt_heading_words:
+        try:
+            headings.append(re.escape(word.encode(encoding)))
+        except UnicodeEncodeError:
+            pass
+    return re.compile(b'^(?:\xef\xbb\xbf)?' + chars(' \t\u3000') + b'*(?:' + b'|'.join(headings) + rb')[^\r\n]{0,100}\r?$', re.MULTILINE)
+
+
+_txt_boms = [  # utf-32要在utf-16之前判断, 因为utf-32-le的BOM以utf-16-le的BOM开头
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+_txt_encodings = ('gb18030', 'big5', 'cp932')  # 没有BOM又不是utf-8时的候选
+# 各语言最常用的一些字, 用来判断哪种解码结果更像人话(解码成功不代表对, gb18030几乎什么字节都能解码)
+_txt_common_chars = set('的一是不了人我在有他这中大来上个国到说们为子和你地出道也时年'
+                        '這來個國說們為時'
+                        'のにはをたがでしてといもなかるれ、。「」')
+
+
+def detect_encoding(path: str, sample_size: int = 64 << 10, blocks: int = 4, block_size: int = 16 << 10) -> str:
+    """
+    判断txt文件的编码, 只读取开头sample_size字节和均匀分布的几个小块, 不会解码整个文件\n
+    先看BOM, 然后能严格按utf-8解码就是utf-8, 否则在候选编码里挑常用字最多、错误最少的
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        samples = [file.read(sample_size)]
+        for bom, encoding in _txt_boms:
+            if samples[0].startswith(bom):
+                return encoding
+        if size > sample_size:
+            for i in range(1, blocks + 1):
+                file.seek(size * i // (blocks + 1))
+                block = file.read(block_size)
+                samples.append(block[block.find(b'\n') + 1:])  # 从换行之后开始, 保证不会从多字节字符中间开始解码
+    try:
+        for sample in samples:
+            codecs.getincrementaldecoder('utf-8')().decode(sample)  # 不传final, 结尾被截断的字符不算错
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    best, best_score = 'utf-8', None
+    for encoding in _txt_encodings:
+        score = 0
+        for sample in samples:
+            text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample)
+            score += sum(ch in _txt_common_chars for ch in text) - 10 * text.count('\ufffd')
+        if best_score is None or score > best_score:
+            best, best_score = encoding, score
+    return best
+
+
+class BookIndex:
+    """
+    磁盘上的书籍索引缓存, 每本书一个json文件, 以 路径+大小+mtime 为键\n
+    记录打开一本书时需要花时间扫描/解析才能得到的信息(epub的root_path、成员索引和navs, txt的编码和分章), 再次打开时读一个小文件就够了\n
+    `kind`用来在同一本书旁边存放别的索引(比如全文搜索的'search'), 它们与书的索引一起过期
+    """
+    version = 3  # 索引格式有变化时+1, 旧的索引就会作废
+
+    def __init__(self, cache_dir: str = 'cache') -> None:
+        self.cache_dir = os.path.abspath(cache_dir)
+
+    def load(self, path: str, kind: str = '') -> Optional[dict]:
+        """读取索引, 不存在或已过期时返回None"""
+        try:
+            with open(self._index_path(path, kind), 'r', encoding='utf-8') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if index.get('key') != self._key(path):
+            return None
+        return index['data']
+
+    def save(self, path: str, data: dict, kind: str = ''):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._index_path(path, kind) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({'key': self._key(path), 'data': data}, file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self._index_path(path, kind))  # 先写临时文件再替换, 中途出错也不会留下坏的索引
+        except OSError as e:  # 写不了缓存也不影响阅读
+            print(f'保存书籍索引失败: {e!r}')
+
+    def _key(self, path: str) -> list:
+        stat = os.stat(path)
+        return [BookIndex.version, os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+    def _index_path(self, path: str, kind: str = '') -> str:
+        name = md5(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{name}.{kind}.json' if kind else name + '.json')
+
+
+book_index = BookIndex()
+
+
+class ChapterCache:
+    """
+    已解析章节的LRU缓存, 键为 (书的路径, mtime, nav编号), 值为`get_content`的最终结果\n
+    按估算的内存占用淘汰最久未使用的章节, 文件在磁盘上被修改后(mtime变化)旧的缓存会被丢弃
+    """
+    Key = Tuple[str, int, int]
+
+    def __init__(self, max_bytes: int = 64 << 20) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._data: 'OrderedDict[ChapterCache.Key, Tuple[List[Union[Text, Image]], int]]' = OrderedDict()
+        self._lock = threading.Lock()  # 预加载等后台线程也会读写
+
+    def get(self, key: Key) -> Optional[List[Union[Text, Image]]]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value[0]
+
+    def put(self, key: Key, contents: List[Union[Text, Image]]):
+        size = ChapterCache.estimate_size(contents)
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            if size > self.max_bytes:  # 单章就超过预算了, 不缓存
+                return
+            self._data[key] = (contents, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self._size -= old_size
+
+    def invalidate(self, path: str, mtime: Optional[int] = None):
+        """丢弃某本书的缓存, 给出mtime时只丢弃mtime不一致的(即过期的)"""
+        with self._lock:
+            for key in [k for k in self._data if k[0] == path and k[1] != mtime]:
+                self._size -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        """当前估算的内存占用(字节)"""
+        return self._size
+
+    @staticmethod
+    def estimate_size(contents: List[Union[Text, Image]]) -> int:
+        """粗略估算内存占用, 只算字符串和对象本身, 够用来做淘汰了"""
+        size = sys.getsizeof(contents)
+        for item in contents:
+            size += sys.getsizeof(item) + sys.getsizeof(item.__dict__)
+            if type(item) is Text:
+                size += sys.getsizeof(item.text) + sys.getsizeof(item.color)
+            else:
+                size += sys.getsizeof(item.src)
+        return size
+
+    def __str__(self) -> str:
+        return f'ChapterCache(items={len(self._data)}, size={self._size}, hits={self.hits}, misses={self.misses})'
+
+
+chapter_cache = ChapterCache()
+
+
 class Epub:
-    """封装了epub文件的一些操作, 目前已追加txt模式"""
-    def __init__(self, path: str):
+    """
+    封装了epub文件的一些操作, 目前已追加txt模式\n
+    epub模式下会在整个生命周期内持有同一个ZipFile句柄, 用完后需要`close`(或者用with语句)
+    """
+
+    class Engine:
+        """解析xhtml的引擎"""
+        stream = 0x0  # lxml流式解析, 一遍出结果
+        soup = 0x1  # BeautifulSoup建树后深搜再查重, 旧引擎, 留着用来对比
+
+    def __init__(self, path: str, engine: int = Engine.stream):
         # 步骤
         # 1. 打开 "META-INF/container.xml", 找到 ['container']['rootfiles']['rootfile']['@full-path'], 应该是个opf文件
-        # 2. 打开 .opf 文件, 找 ['package']['manifest']['item'] 应该是个列表, 找到 id=ncx 的 href, 应该是个ncx
+        # 2. 打开 .opf 文件, 按 ['package']['spine'] 得到阅读顺序, 再从 ['package']['manifest']['item'] 里找目录(nav.xhtml或ncx)
+        # 3. 每个目录项对应spine上的一段范围, 从它指向的位置到下一个目录项指向的位置, 见`_build_ranges`
         self.is_txt = path.lower().endswith('.txt')
         self.epub_path = path
+        self.engine = engine
+        self._mtime = os.stat(path).st_mtime_ns
+        self._zip: Optional[ZipFile] = None
+        self._lock = threading.Lock()  # ZipFile共用一个文件指针, 多线程读取时需要加锁
+        self._closed = False
+        self._parsed: Optional[Tuple[str, List[Union[Text, Image, str]]]] = None  # 最近解析的被多个目录项共用的文件, 下一个目录项直接切片
         if not self.is_txt:
-            with ZipFile(path) as zip:
-                name_set = set(zip.namelist())
-                opf_path = xmltodict.parse(zip.read('META-INF/container.xml').decode())['container']['rootfiles']['rootfile']['@full-path']
-                root_path: str = os.path.dirname(opf_path)
-                ncx_path = ''
-                for item in xmltodict.parse(zip.read(opf_path).decode())['package']['manifest']['item']:
-                    if item['@id'] == 'ncx':
-                        ncx_path = Epub.path_join(root_path, item['@href'])
-                        break
-                ncx = BeautifulSoup(zip.read(ncx_path).decode(), features='lxml').find('ncx')
-            self.root_path = root_path
-            self.name_set: Set[str] = name_set
-            self.navs: List[Nav] = [Nav(navpoint, i) for i, navpoint in enumerate(ncx.find('navmap').find_all('navpoint'))]
+            index = book_index.load(path)
+            if index is not None:  # 有索引的话连zip都先不用打开, 第一次读取时再打开
+                self.root_path: str = index['root_path']
+                self.members: Dict[str, ZipInfo] = {name: Epub._zip_info(name, *sizes) for name, *sizes in index['members']}
+                self.spine: List[str] = index['spine']
+                self.navs: List[Nav] = [Nav(None, i, text, src, level) for i, (text, src, level) in enumerate(index['navs'])]
+            else:
+                self._zip = ZipFile(path)
+                # 成员索引, 文件名 => ZipInfo (大小、压缩方式等都在里面), 查找和取大小都是O(1)
+                self.members: Dict[str, ZipInfo] = {info.filename: info for info in self._zip.infolist()}
+                opf_path = xmltodict.parse(self.read('META-INF/container.xml').decode())['container']['rootfiles']['rootfile']['@full-path']
+                self.root_path = os.path.dirname(opf_path)
+                self.spine, self.navs = self._read_navigation(opf_path)
+                book_index.save(path, {
+                    'root_path': self.root_path,
+                    'members': [[info.filename, info.file_size, info.compress_size, info.compress_type] for info in self.members.values()],
+                    'spine': self.spine,
+                    'navs': [[nav.text, nav.src, nav.level] for nav in self.navs],
+                })
+            self._build_ranges()
         else:
             self.root_path = ''  # txt模式下没有root_path(epub文件内根路径)
-            self.name_set: Set[str] = set()  # txt模式下没有name_set(epub文件内文件名集合)
-            self.navs: List[Nav] = [Nav(None, 0, '1')]  # txt模式下只有一个Nav
+            self.members: Dict[str, ZipInfo] = {}  # txt模式下没有members(epub文件内的成员索引)
+            index = book_index.load(path)
+            if index is not None:
+                self.encoding: str = index['encoding']
+                self.navs = [Nav(None, i, title) for i, title in enumerate(index['titles'])]
+                self.txt_ranges: List[Tuple[int, int]] = [tuple(r) for r in index['ranges']]
+            else:
+                self.encoding = detect_encoding(path)
+                self.navs, self.txt_ranges = self._index_txt()
+                book_index.save(path, {'encoding': self.encoding, 'titles': [nav.text for nav in self.navs], 'ranges': self.txt_ranges})
+
+    def _read_navigation(self, opf_path: str) -> Tuple[List[str], List[Nav]]:
+        """
+        从opf读取spine(阅读顺序)和目录: 优先用EPUB3的nav.xhtml, 没有再用NCX, 都没有就每个文件算一章\n
+        目录保持原有的嵌套层级; 第一个文件没有目录项指向(比如封面)的话补一个"开头", 不会丢内容
+        """
+        package = xmltodict.parse(self.read(opf_path).decode())['package']
+        manifest = {item['@id']: item for item in Epub._as_list(package['manifest']['item'])}
+        spine_tag = package.get('spine') or {}
+        refs = [(Epub.path_join(self.root_path, manifest[ref['@idref']]['@href']), ref.get('@linear') != 'no')
+                for ref in Epub._as_list(spine_tag.get('itemref')) if ref.get('@idref') in manifest]
+        navs: List[Nav] = []
+        nav_item = next((item for item in manifest.values() if 'nav' in item.get('@properties', '').split()), None)
+        if nav_item is not None:
+            navs = self._read_nav_xhtml(Epub.path_join(self.root_path, nav_item['@href']))
+        if not navs:
+            ncx_item = manifest.get(spine_tag.get('@toc', '')) or manifest.get('ncx')\
+                or next((item for item in manifest.values() if item.get('@media-type') == 'application/x-dtbncx+xml'), None)
+            if ncx_item is not None:
+                navs = self._read_ncx(Epub.path_join(self.root_path, ncx_item['@href']))
+        if not navs:
+            navs = [Nav(None, i, str(i + 1), path) for i, path in enumerate(path for path, linear in refs if linear)]
+        targets = { nav.src.partition('#')[0] for nav in navs }
+        spine = [path for path, linear in refs if linear or path in targets]  # 不在阅读顺序里(比如目录页、注释)又没有目录项指向的文件不要
+        for nav in navs:  # 不规范的书里目录可能指向spine以外的文件, 接在最后
+            path = nav.src.partition('#')[0]
+            if path not in spine:
+                spine.append(path)
+        if spine and spine[0] not in { nav.src for nav in navs }:
+            first = next((nav for nav in navs if nav.src.partition('#')[0] == spine[0]), None)
+            if first is not None:  # 指向第一个文件中间的某处(c1.xhtml#c1), 直接从文件开头算起, 前面的内容(多半为空)归它
+                first.src = spine[0]
+            else:  # 第一个文件没有目录项指向, 是封面之类, 单独算一章
+                navs.insert(0, Nav(None, 0, '开头', spine[0]))
+                for i, nav in enumerate(navs):
+                    nav.index = i
+        return spine, navs
+
+    def _read_nav_xhtml(self, path: str) -> List[Nav]:
+        """EPUB3的目录, 即 <nav epub:type="toc"> 里嵌套的 ol > li > a"""
+        soup = BeautifulSoup(self.read(path).decode(), features='lxml')
+        tags = soup.find_all('nav')
+        toc = next((tag for tag in tags if 'toc' in (tag.get('epub:type') or '').split()), tags[0] if tags else None)
+        ol = toc.find('ol') if toc is not None else None
+        navs: List[Nav] = []
+        stack = [(ol, 0)] if ol is not None else []  # (ol, 层级), 倒着压栈保证按顺序出栈
+        while stack:
+            tag, level = stack.pop()
+            if tag.name != 'li':
+                stack.extend((li, level) for li in reversed(tag.find_all('li', recursive=False)))
+                continue
+            link = tag.find('a', recursive=False) or tag.find('span', recursive=False)
+            child = tag.find('ol', recursive=False)
+            if link is not None and link.get('href'):
+                navs.append(Nav(None, len(navs), ' '.join(link.text.split()), Epub.resolve_href(os.path.dirname(path), link['href']), level))
+                level += 1
+            if child is not None:  # 没有链接的分组标题就不算一级了
+                stack.append((child, level))
+        return navs
+
+    def _read_ncx(self, path: str) -> List[Nav]:
+        """EPUB2的目录, navMap里嵌套的navPoint"""
+        ncx = BeautifulSoup(self.read(path).decode(), features='lxml').find('ncx')
+        navmap = ncx.find('navmap') if ncx is not None else None
+        navs: List[Nav] = []
+        stack = [(navmap, -1)] if navmap is not None else []
+        while stack:
+            tag, level = stack.pop()
+            if tag.name == 'navpoint':
+                nav = Nav(tag, len(navs), level=level)
+                nav.src = Epub.resolve_href(os.path.dirname(path), nav.src)
+                navs.append(nav)
+            stack.extend((navpoint, level + 1) for navpoint in reversed(tag.find_all('navpoint', recursive=False)))
+        return navs
+
+    def _build_ranges(self):
+        """
+        算出每个目录项在spine上的范围 [start, end) 和目录树中的上一级\n
+        同一个文件里的片段按在目录中出现的先后排序, 文件开头排在所有片段前面; 终点是排在它后面的下一个位置
+        """
+        spine_index = {path: i for i, path in enumerate(self.spine)}
+        orders: Dict[str, Dict[str, int]] = {}  # 文件 => 片段 => 在目录中出现的先后
+        self._fragments: Dict[str, Set[str]] = {}  # 文件 => 需要标记的片段id
+        keys: List[Tuple[int, int]] = []
+        positions: Dict[Tuple[int, int], Tuple[int, str]] = {}
+        for nav in self.navs:
+            path, _, fragment = nav.src.partition('#')
+            order = orders.setdefault(path, { '': 0 })
+            if fragment not in order:
+                order[fragment] = len(order)
+                self._fragments.setdefault(path, set()).add(fragment)
+            nav.start = (spine_index[path], fragment)
+            keys.append((spine_index[path], order[fragment]))
+            positions[keys[-1]] = nav.start
+        boundaries = sorted(positions)
+        parents: List[Nav] = []
+        for nav, key in zip(self.navs, keys):
+            i = bisect_right(boundaries, key)
+            nav.end = positions[boundaries[i]] if i < len(boundaries) else (len(self.spine), '')
+            while parents and parents[-1].level >= nav.level:
+                parents.pop()
+            nav.parent = parents[-1].index if parents else None
+            parents.append(nav)
+
+    def _index_txt(self, chapter_size: int = 64 << 10) -> Tuple[List[Nav], List[Tuple[int, int]]]:
+        """
+        用mmap在字节层面扫一遍txt, 按章节标题切分, 返回navs和每章的字节范围 [start, end)\n
+        找不到标题(或者是utf-16这类换行不止一个字节的编码)的话就按chapter_size大小在换行处切分
+        """
+        size = os.path.getsize(self.epub_path)
+        if size == 0:  # mmap不能映射空文件
+            return [Nav(None, 0, '1')], [(0, 0)]
+        encoding = 'utf-8' if self.encoding == 'utf-8-sig' else self.encoding  # utf-8-sig编码时每次都会加上BOM
+        newline = '\n'.encode(encoding)
+        offsets: List[int] = []
+        titles: List[str] = []
+        with open(self.epub_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = next((len(bom) for bom, encoding in _txt_boms if encoding == self.encoding and mm[:len(bom)] == bom), 0)
+            if newline == b'\n':
+                pattern = txt_heading_pattern(encoding)
+                for match in pattern.finditer(mm):
+                    if not offsets and match.start() > start and mm[start:match.start()].strip():  # 第一个标题前还有内容
+                        offsets.append(start)
+                        titles.append('开头')
+                    offsets.append(match.start())
+                    titles.append(match.group().decode(self.encoding, errors='replace').strip())
+            if not offsets:
+                pos = start
+                while pos < size:
+                    offsets.append(pos)
+                    titles.append(str(len(titles) + 1))
+                    end = mm.find(newline, pos + chapter_size)
+                    while end != -1 and (end - start) % len(newline):  # 多字节换行要对齐到字符边界
+                        end = mm.find(newline, end + 1)
+                    pos = size if end == -1 else end + len(newline)
+        navs = [Nav(None, i, title) for i, title in enumerate(titles)]
+        return navs, list(zip(offsets, offsets[1:] + [size]))
 
     def get_content(self, idx: int) -> List[Union[Text, Image]]:
-        """根据navs的编号获取对应的所有内容"""
+        """根据navs的编号获取对应的所有内容, 结果会被缓存, 所以不要修改返回的列表"""
+        key = self._cache_key(idx)
+        contents = chapter_cache.get(key)
+        if contents is None:
+            contents = list(self._iter_content(idx))
+            chapter_cache.put(key, contents)
+        return contents
+
+    def iter_content(self, idx: int, cache: bool = True) -> Generator[Union[Text, Image], None, None]:
+        """
+        `get_content`的流式版本, 边解析边产出, 可以先显示开头的段落; 完整遍历完后同样会进入缓存\n
+        `cache=False`时不把结果放进缓存(已经缓存的仍然会用), 适合建搜索索引这种整本书扫一遍的场合, 免得把正在读的章节挤出去
+        """
+        key = self._cache_key(idx)
+        contents = chapter_cache.get(key)
+        if contents is not None:
+            yield from contents
+            return
+        if not cache:
+            yield from self._iter_content(idx)
+            return
+        contents = []
+        for item in self._iter_content(idx):
+            contents.append(item)
+            yield item
+        chapter_cache.put(key, contents)
+
+    def _cache_key(self, idx: int) -> ChapterCache.Key:
+        path = os.path.abspath(self.epub_path)
+        mtime = os.stat(path).st_mtime_ns
+        if mtime != self._mtime:  # 文件在磁盘上被修改过了
+            chapter_cache.invalidate(path, mtime)
+            self._mtime = mtime
+        return (path, mtime, idx)
+
+    def _iter_content(self, idx: int) -> Generator[Union[Text, Image], None, None]:
+        """实际的读取与解析, 不经过缓存; 按spine依次读取目录项范围内的文件, 首尾两个文件按片段id切片"""
         if self.is_txt:
-            assert idx == 0
-            return list(self._read_txt(self.epub_path))
-        path = Epub.path_join(self.root_path, self.navs[idx].src)
-        if path not in self.name_set:
-            return [Text(f'错误: 在epub文件中找不到 {path} !')]
-        with ZipFile(self.epub_path) as zip:
-            body = BeautifulSoup(zip.read(path).decode(), features='lxml').find('body')
-        contents: List[Union[Text, Image]] = []
-        for i, item in enumerate(Epub._dfs(body, os.path.dirname(path))):
-            if i == 0:
-                contents.append(item)
+            yield from self._read_txt(idx)
+            return
+        (first, begin), (last, end) = self.navs[idx].start, self.navs[idx].end
+        for i in range(first, min(last + 1 if end else last, len(self.spine))):
+            path = self.spine[i]
+            if path not in self.members:
+                yield Text(f'错误: 在epub文件中找不到 {path} !')
+                continue
+            yield from Epub._slice(self._iter_file(path), begin if i == first else '', end if i == last else '')
+
+    def _iter_file(self, path: str) -> Generator[Union[Text, Image, str], None, None]:
+        """解析spine中的一个文件, 产出内容以及目录项指向的id(str, 作为切片的标记); 被多个目录项共用的文件只解析一次"""
+        parsed = self._parsed
+        if parsed is not None and parsed[0] == path:
+            yield from parsed[1]
+            return
+        ids = self._fragments.get(path, set())
+        contents: List[Union[Text, Image, str]] = []
+        if self.engine == Epub.Engine.stream:
+            items = Epub._stream_extract(self.read(path).decode(), os.path.dirname(path), ids)
+        else:
+            items = Epub._soup_extract(self.read(path).decode(), os.path.dirname(path), ids)
+        for item in items:
+            contents.append(item)
+            yield item
+        if ids:
+            self._parsed = (path, contents)
+
+    @staticmethod
+    def _slice(items: Iterable[Union[Text, Image, str]], begin: str, end: str) -> Generator[Union[Text, Image], None, None]:
+        """
+        只产出标记begin之后、标记end之前的内容, 为空则从头开始/直到结尾\n
+        找不到begin就从头开始; 不会提前退出, 后面的内容还要留给下一个目录项
+        """
+        started, stopped = not begin, False
+        skipped: List[Union[Text, Image]] = []  # 还没找到起点时先攒着
+        for item in items:
+            if type(item) is str:
+                if item == begin and not started:
+                    started, skipped = True, []
+                elif item == end and started:
+                    stopped = True
+            elif stopped:
+                continue
+            elif started:
+                yield item
             else:
-                if type(contents[-1]) is Text and type(item) is Text and contents[-1].source is not item.source and contents[-1].text == item.text:
-                    if contents[-1].source is NavigableString:
-                        contents[-1] = item
-                    elif item.source is NavigableString:
-                        pass
-                else:
-                    contents.append(item)
-        return contents
+                skipped.append(item)
+        if not started:
+            yield from skipped
 
     def read(self, src: str) -> bytes:
         """
-        epub里的html/xhtml等文件中src往往使用相对路径, 但这已经在`get_content`中处理过了, 因此这里的src同样必须使用绝对路径
+        epub里的html/xhtml等文件中src往往使用相对路径, 但这已经在`get_content`中处理过了, 因此这里的src同样必须使用绝对路径\n
+        线程安全, 可以在后台线程中调用
         """
-        if src not in self.name_set:
+        info = self.members.get(src)
+        if info is None:
+            raise KeyError(f'在epub文件中找不到 {src} !')
+        with self._lock:
+            return self._archive().read(info.filename)
+
+    def read_prefix(self, src: str, size: int) -> bytes:
+        """只解压文件开头的size字节, 用来读取图片头之类的信息, 同样线程安全"""
+        info = self.members.get(src)
+        if info is None:
             raise KeyError(f'在epub文件中找不到 {src} !')
-        with ZipFile(self.epub_path) as zip:
-            return zip.read(src)
+        with self._lock:
+            with self._archive().open(info.filename) as file:
+                return file.read(size)
+
+    def _archive(self) -> ZipFile:
+        """获取ZipFile句柄, 必须在持有self._lock时调用"""
+        if self._closed:
+            raise ValueError(f'epub文件已关闭: {self.epub_path}')
+        if self._zip is None:
+            self._zip = ZipFile(self.epub_path)
+        return self._zip
+
+    def file_size(self, src: str) -> int:
+        """不解压直接获取文件(解压后)的大小"""
+        info = self.members.get(src)
+        if info is None:
+            raise KeyError(f'在epub文件中找不到 {src} !')
+        return info.file_size
+
+    @staticmethod
+    def _zip_info(name: str, file_size: int, compress_size: int, compress_type: int) -> ZipInfo:
+        """从索引还原ZipInfo, 只用于查询, 实际读取时还是按文件名从ZipFile里读"""
+        info = ZipInfo(name)
+        info.file_size = file_size
+        info.compress_size = compress_size
+        info.compress_type = compress_type
+        return info
+
+    def close(self):
+        """关闭持有的ZipFile句柄, 可以重复调用"""
+        with self._lock:
+            self._closed = True
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+    def __enter__(self) -> 'Epub':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _read_txt(self, idx: int, block_size: int = 64 << 10) -> Generator[Text, None, None]:
+        """
+        读取txt文件的第idx章(seek到对应的字节范围), 生成Text (用yield是为了减少append的使用)\n
+        分块读取, 用增量解码器解码, 块边界落在多字节字符中间也没关系
+        """
+        start, end = self.txt_ranges[idx]
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        rest = ''  # 上一块末尾不完整的一行
+        with open(self.epub_path, 'rb') as file:
+            file.seek(start)
+            while start < end:
+                data = file.read(min(block_size, end - start))
+                if not data:
+                    break
+                start += len(data)
+                lines = (rest + decoder.decode(data, final=start >= end)).splitlines(keepends=True)
+                rest = lines.pop() if lines and start < end and not lines[-1].endswith(('\n', '\r')) else ''
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        yield Text(line)
+        rest = (rest + decoder.decode(b'', final=True)).strip()
+        if rest:
+            yield Text(rest)
 
     @staticmethod
-    def _read_txt(path: str) -> Generator[Text, None, None]:
-        """读取txt文件, 生成Text (用yield是为了减少append的使用)"""
-        with open(path, 'r', encoding='utf-8') as file:
-            for line in file:
-                line = line.strip()
-                if line:
-                    yield Text(line)
+    def _stream_extract(markup: str, root: str, ids: Iterable[str] = (), chunk_size: int = 16 << 10) -> Generator[Union[Text, Image, str], None, None]:
+        """流式解析html/xhtml, 参数同`_dfs`; 分块喂给解析器, 每块解析完就把新产生的内容交出去"""
+        extractor = _StreamExtractor(root, ids)
+        parser = etree.HTMLParser(target=extractor, recover=True)
+        sent = 0
+        for start in range(0, len(markup), chunk_size):
+            parser.feed(markup[start: start + chunk_size])
+            yield from extractor.contents[sent:]  # 已经产出的内容之后不会再变
+            sent = len(extractor.contents)
+        parser.close()
+        yield from extractor.contents[sent:]
 
     @staticmethod
-    def _dfs(tag: Tag, root: str) -> List[Union[Text, Image]]:
+    def _soup_extract(markup: str, root: str, ids: Iterable[str] = ()) -> Generator[Union[Text, Image, str], None, None]:
+        """旧引擎: 建树后`_dfs`, 再对相邻的重复文本查重"""
+        ids = set(ids)
+        body = BeautifulSoup(markup, features='lxml').find('body')
+        if body.get('id') in ids:
+            yield body['id']
+        last: Optional[Union[Text, Image]] = None  # 查重需要看前一项, 所以总是晚一项产出
+        for item in Epub._dfs(body, root, ids):
+            if type(item) is str:  # 标记不参与查重
+                if last is not None:
+                    yield last
+                last = None
+                yield item
+                continue
+            if type(last) is Text and type(item) is Text and last.source is not item.source and last.text == item.text:
+                if last.source is NavigableString:
+                    last = item
+                continue
+            if last is not None:
+                yield last
+            last = item
+        if last is not None:
+            yield last
+
+    @staticmethod
+    def _dfs(tag: Tag, root: str, ids: Set[str] = frozenset()) -> Generator[Union[Text, Image, str], None, None]:
         """
         针对html/xhtml等文件中的树状结构，用深搜的方式顺序得到所有文本或图片内容。\n
+        用显式栈代替递归并逐项yield, 嵌套再深也不会爆栈, 也不用层层拼接列表。\n
         由于NavigableString和Tag内容经常会重复，需要对得到的内容进行查重操作，本来可以在这个方法内部实现的，但考虑到效率还是在外面一次遍历搞定吧。
         :param root: 就是所读文件在epub文件内所处的目录，因为图片的src是基于该文件的相对路径，所以需要提供
+        :param ids: 目录项指向的id, 遇到这些标签时先产出它的id(str)作为标记
         """
-        contents: List[Union[Text, Image]] = []
-        without_children = True
-        for child in tag.children:
-            if type(child) is Tag:
-                without_children = False
-                contents.extend(Epub._dfs(child, root))
+        stack = [[tag, iter(tag.children), True]]  # [标签, 子节点迭代器, 是否没有子标签]
+        while stack:
+            frame = stack[-1]
+            child = next(frame[1], None)
+            if child is None:  # 子节点遍历完了
+                stack.pop()
+                if frame[2]:
+                    item = Epub._leaf(frame[0], root)
+                    if item is not None:
+                        yield item
+            elif type(child) is Tag:
+                frame[2] = False
+                if ids and child.get('id') in ids:
+                    yield child['id']
+                stack.append([child, iter(child.children), True])
             elif type(child) is NavigableString:
                 child = child.strip()
                 if child:
-                    contents.append(Text(child, source=NavigableString))
+                    yield Text(child, source=NavigableString)
             elif type(child) in { Comment, Stylesheet }:
                 pass
             else:
-                contents.append(Text(f'不支持的类型 {type(child)} , 值为 {child}。'))
-        if without_children:
-            if tag.name == 'img':
-                src = tag.get('src')
-                if not src.lower().startswith('http'):  # 就NM离谱，怎么会有网络图片的啦
-                    src = Epub.path_join(root, src)
-                    contents.append(Image(src))
-            else:
-                # Text
-                text = Text(tag.text.strip())
-                # check name
-                if tag.name in { 'h1', 'h2', 'h3' }:
-                    text.header_level = int(tag.name[-1])
-                elif tag.name == 'b':
-                    text.strong = True
-                # check style
-                style = Epub.parse_style(tag)
-                text.align = style.get('text-align', '')
-                text.color = style.get('color', '')
-                if style.get('font-weight', '') == 'bold':
-                    text.strong = True
-                del style
-                # apend
-                if tag.name not in { 'style', 'link' }:
-                    contents.append(text)
-        return contents
+                yield Text(f'不支持的类型 {type(child)} , 值为 {child}。')
+
+    @staticmethod
+    def _leaf(tag: Tag, root: str) -> Optional[Union[Text, Image]]:
+        """没有子标签的标签本身对应的内容"""
+        if tag.name == 'img':
+            src = tag.get('src')
+            if not src.lower().startswith('http'):  # 就NM离谱，怎么会有网络图片的啦
+                src = Epub.path_join(root, src)
+                return Image(src)
+        elif tag.name not in { 'style', 'link' }:
+            return Epub.styled_text(tag.name, tag.text.strip(), tag)
+        return None
 
     @staticmethod
-    def parse_style(tag: Tag) -> Dict[str, str]:
+    def styled_text(name: str, text: str, tag: Union[Tag, Dict[str, str]]) -> Text:
+        """根据标签名和style生成Text, tag也可以是属性字典"""
+        result = Text(text)
+        # check name
+        if name in { 'h1', 'h2', 'h3' }:
+            result.header_level = int(name[-1])
+        elif name == 'b':
+            result.strong = True
+        # check style
+        style = Epub.parse_style(tag)
+        result.align = style.get('text-align', '')
+        result.color = style.get('color', '')
+        if style.get('font-weight', '') == 'bold':
+            result.strong = True
+        return result
+
+    @staticmethod
+    def parse_style(tag: Union[Tag, Dict[str, str]]) -> Dict[str, str]:
         style = tag.get('style')
         if style is None:
             return {}
@@ -213,7 +902,7 @@ class Epub:
     def path_join(root: str, name: str) -> str:
         """代替os.path的路径拼接, 因为正反斜杠等各种符号问题"""
         # 处理name里包含..
-        if name.startswith('../'):
+        while name.startswith('../'):
             name = name[3:]
             root = os.path.dirname(root)
         # 处理正反斜杠问题
@@ -225,5 +914,49 @@ class Epub:
         # 处理url里的%XX
         return unquote(s)
 
+    @staticmethod
+    def resolve_href(root: str, href: str) -> str:
+        """目录里的链接转成epub内的绝对路径, 和`path_join`不同的是保留#片段"""
+        href, _, fragment = href.partition('#')
+        path = Epub.path_join(root, href)
+        return f'{path}#{unquote(fragment)}' if fragment else path
+
+    @staticmethod
+    def _as_list(value) -> list:
+        """xmltodict在只有一项时不会给列表"""
+        if value is None:
+            return []
+        return value if type(value) is list else [value]
+
     def __str__(self) -> str:
         return f'Epub(root_path={self.root_path})'
+
+
+def compare_engines(path: str) -> List[str]:
+    """用两个引擎分别解析同一本书的每一章, 返回所有不一致之处(空列表即完全一致)"""
+    def key(item: Union[Text, Image]) -> tuple:
+        if type(item) is Image:
+            return ('Image', item.src)
+        return ('Text', item.text, item.header_level, item.strong, item.align, item.color)
+
+    diffs: List[str] = []
+    with Epub(path, Epub.Engine.stream) as stream, Epub(path, Epub.Engine.soup) as soup:
+        for nav in stream.navs:
+            try:
+                a = [key(item) for item in stream._iter_content(nav.index)]
+                b = [key(item) for item in soup._iter_content(nav.index)]
+            except Exception as e:
+                diffs.append(f'{path} {nav}: 解析出错 {e!r}')
+                continue
+            if a != b:
+                i = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+                diffs.append(f'{path} {nav}: 第{i}项起不一致, stream={a[i:i + 1]}, soup={b[i:i + 1]}, 长度{len(a)}/{len(b)}')
+    return diffs
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        diffs = compare_engines(path)
+        for diff in diffs:
+            print(diff)
+        print(f'{path}: {"一致" if not diffs else f"{len(diffs)}章不一致"}')
@@ -1,15 +1,251 @@
+from bisect import bisect_right
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
 import os
 import sys
-from typing import List, Optional
-
-from PySide2.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QSplitter, QLineEdit, QAction, QMenu, QFileDialog
-from PySide2.QtGui import QFont, QPixmap, QImage, QKeyEvent, QContextMenuEvent, QCloseEvent, QResizeEvent
-from PySide2.QtCore import Qt, QTimer
+import threading
+import time
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple, Union
+
+from PySide2.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QSplitter, QLineEdit, QAction, QMenu, QFileDialog, QAbstractScrollArea, QListWidget, QListWidgetItem
+from PySide2.QtGui import QFont, QFontMetrics, QPainter, QPalette, QColor, QPixmap, QPixmapCache, QImage, QImageReader, QKeyEvent, QContextMenuEvent, QCloseEvent, QResizeEvent, QPaintEvent
+from PySide2.QtCore import Qt, QObject, Signal, QRect, QSize, QBuffer, QByteArray, QIODevice, QTimer
 from qtmodern.styles import dark as dark_style, light as light_style
 
 import epub
 from utils import FileDragable, singleton, ScrollArea
-from speak import Speaker
+from search import SearchIndex
+from speak import Prerenderer, Speaker
+
+
+@singleton
+class ReaderData:
+    """阅读器相关的配置"""
+    def __init__(self) -> None:
+        with open('config.json', 'r', encoding='utf-8') as file:
+            data = json.load(file).get('reader', {})  # 兼容没有reader项的旧配置文件
+        self.prefetch: int = data.get('prefetch', 1)
+        self.decode_workers: int = data.get('decode_workers', 2)
+        del data
+
+    def __str__(self) -> str:
+        return f'ReaderData(prefetch={self.prefetch}, decode_workers={self.decode_workers})'
+
+
+@singleton
+class ImageCache:
+    """
+    解码后的QImage缓存, 键为 (书的路径, 图片src), 按占用字节数做LRU淘汰\n
+    线程安全(QImage不同于QPixmap, 可以在非GUI线程中创建), 预加载线程会往里面放
+    """
+    def __init__(self, max_bytes: int = 256 << 20) -> None:
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._data: 'OrderedDict[Tuple[str, str], QImage]' = OrderedDict()
+        self._sizes: Dict[Tuple[str, str], QSize] = {}  # 图片原本的尺寸, 很小, 不做淘汰
+        self._lock = threading.Lock()
+
+    def get(self, path: str, src: str) -> Optional[QImage]:
+        with self._lock:
+            image = self._data.get((path, src))
+            if image is not None:
+                self._data.move_to_end((path, src))
+            return image
+
+    def put(self, path: str, src: str, image: QImage):
+        with self._lock:
+            if (path, src) in self._data:
+                self._size -= self._data.pop((path, src)).sizeInBytes()
+            self._data[(path, src)] = image
+            self._size += image.sizeInBytes()
+            while self._size > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self._size -= old.sizeInBytes()
+
+    def image_size(self, path: str, src: str) -> Optional[QSize]:
+        with self._lock:
+            return self._sizes.get((path, src))
+
+    def set_image_size(self, path: str, src: str, size: QSize):
+        with self._lock:
+            self._sizes[(path, src)] = size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._size = 0
+
+
+@singleton
+class Prefetcher:
+    """在后台线程预加载相邻章节(解析内容并解码图片), 这样翻页时就能直接命中缓存"""
+    def __init__(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._futures: List[Future] = []
+        self._generation = 0  # 每次取消都会+1, 旧任务发现对不上就自行退出
+
+    def schedule(self, book: epub.Epub, nav_id: int):
+        """取消之前的预加载, 然后预加载nav_id的下几章和上一章"""
+        self.cancel()
+        generation = self._generation
+        for idx in [nav_id + i for i in range(1, ReaderData().prefetch + 1)] + [nav_id - 1]:
+            if 0 <= idx < len(book.navs):
+                self._futures.append(self._executor.submit(self._prefetch, book, idx, generation))
+
+    def cancel(self):
+        self._generation += 1
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _prefetch(self, book: epub.Epub, idx: int, generation: int):
+        if generation != self._generation:
+            return
+        try:
+            cache = ImageCache()
+            for item in book.get_content(idx):
+                if generation != self._generation:  # 用户已经跳到别的地方了
+                    return
+                if type(item) is epub.Image and item.src in book.members and cache.get(book.epub_path, item.src) is None:
+                    cache.put(book.epub_path, item.src, QImage.fromData(book.read(item.src)))
+        except Exception as e:  # 预加载失败无所谓, 真正打开的时候会再报错
+            if generation == self._generation:  # 换书时旧书被关掉导致的失败不用管
+                print(f'预加载第{idx}章失败: {e!r}')
+
+
+@singleton
+class ImageDecoder(QObject):
+    """
+    在线程池里读取、解码并缩放图片, 完成后通过信号把结果送回GUI线程\n
+    同一张图同一个大小的请求在完成前只会执行一次; 换章节时`cancel`, 还没开始的旧任务会直接放弃
+    """
+    decoded = Signal(int, str, str, QSize, QImage)  # 提交时的generation, QPixmapCache的键, 图片src, 原图大小, 缩放好的图片
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=max(ReaderData().decode_workers, 1), thread_name_prefix='decode')
+        self._in_flight: Dict[str, int] = {}  # 键 => 提交时的generation
+        self._generation = 0
+
+    def request(self, book: epub.Epub, src: str, size: QSize, key: str):
+        """把src解码并缩放到size, key同时用来去重"""
+        if key in self._in_flight:
+            return
+        self._in_flight[key] = self._generation
+        self._executor.submit(self._decode, book, src, size, key, self._generation)
+
+    def done(self, key: str, generation: int):
+        """结果已经在GUI线程处理完了; cancel之前提交的任务不能把之后同一个键的新任务也算作完成"""
+        if self._in_flight.get(key) == generation:
+            del self._in_flight[key]
+
+    def cancel(self):
+        self._generation += 1
+        self._in_flight.clear()
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _decode(self, book: epub.Epub, src: str, size: QSize, key: str, generation: int):
+        if generation != self._generation:  # 用户已经离开这一章了
+            return
+        try:
+            image = ImageCache().get(book.epub_path, src)
+            if image is None:
+                image = QImage.fromData(book.read(src))
+                ImageCache().put(book.epub_path, src, image)
+            original = image.size()
+            if not image.isNull() and original != size:
+                image = image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        except Exception as e:
+            print(f'解码图片 {src} 失败: {e!r}')
+            original, image = QSize(0, 0), QImage()
+        self.decoded.emit(generation, key, src, original, image)
+
+
+@singleton
+class ChapterLoader(QObject):
+    """
+    章节加载分两步: 后台线程解析(`Epub.iter_content`), 每解析出一批就送回GUI线程追加到EpubContent\n
+    每次加载都有自己的generation, 新的跳转会让还在进行的旧加载作废
+    """
+    batch_size = 150
+    batch_loaded = Signal(int, int, object)  # generation, nav_id, 一批内容
+    finished = Signal(int, int)  # generation, nav_id
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loader')
+        self._generation = 0
+        self._started = 0  # 已经开始往EpubContent里填内容的generation
+        self.loading = False
+        self.pending_item: Optional[int] = None  # 加载完后要滚动到的行(从搜索结果跳转过来时)
+        self.batch_loaded.connect(self._on_batch)
+        self.finished.connect(self._on_finished)
+
+    def load(self, book: epub.Epub, nav_id: int):
+        self._generation += 1
+        self.loading = True
+        self.pending_item = None
+        EpubContent().set_loading(True)
+        self._executor.submit(self._load, book, nav_id, self._generation)
+
+    def cancel(self):
+        self._generation += 1
+        self.loading = False
+        EpubContent().set_loading(False)
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _load(self, book: epub.Epub, nav_id: int, generation: int):
+        """在后台线程中运行"""
+        batch: List[Union[epub.Text, epub.Image]] = []
+        try:
+            for item in book.iter_content(nav_id):  # 边解析边显示
+                if generation != self._generation:  # 已经跳到别的章节了
+                    return
+                if type(item) is epub.Image and item.src not in book.members:
+                    item = epub.Text(repr(KeyError(f'在epub文件中找不到 {item.src} !')))
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    self.batch_loaded.emit(generation, nav_id, batch)
+                    batch = []
+        except Exception as e:
+            batch.append(epub.Text(f'加载失败: {e!r}'))
+        self.batch_loaded.emit(generation, nav_id, batch)  # 就算是空的也要发, 第一批会清空旧内容
+        self.finished.emit(generation, nav_id)
+
+    def _on_batch(self, generation: int, nav_id: int, batch: List[Union[epub.Text, epub.Image]]):
+        if generation != self._generation:
+            return
+        content = EpubContent()
+        if self._started != generation:  # 第一批到了才清空旧章节, 避免中途出现空白
+            self._started = generation
+            content.clearItems()
+        content.addItems(batch)
+
+    def _on_finished(self, generation: int, nav_id: int):
+        if generation != self._generation:
+            return
+        main = MainWindow()
+        self.loading = False
+        EpubContent().set_loading(False)
+        if self.pending_item is not None:
+            EpubContent().scroll_to_item(self.pending_item)
+            self.pending_item = None
+        main.setWindowTitle(f'{main.epub.navs[nav_id].text} - {os.path.splitext(os.path.basename(Data().path))[0]} - EpubReader')
+        Prefetcher().schedule(main.epub, nav_id)
+        Searcher().start(main.epub)  # 第一章显示出来之后再建索引, 不和它抢
 
 
 @singleton
@@ -30,11 +266,19 @@ class Data:
         self._path = path
 
         main = MainWindow()
+        ChapterLoader().cancel()
+        Prefetcher().cancel()
+        ImageDecoder().cancel()
+        ImageCache().clear()
+        Searcher().cancel()
+        if main.epub is not None:
+            main.epub.close()
         main.epub = epub.Epub(path)
         menu = Menu()
         menu.clearWidgets()
         for nav in main.epub.navs:
             menu.addWidget(MenuButton(nav))
+        SearchBox().clear()
         self.nav_id = 0
 
     @property
@@ -48,10 +292,11 @@ class Data:
 
         main = MainWindow()
         menu = Menu()
-        content = EpubContent()
 
         if not main.epub or not 0 <= nav_id < len(main.epub.navs):
             return
+        Prefetcher().cancel()  # 跳到别的章节了, 别让预加载和当前章节抢资源
+        ImageDecoder().cancel()
 
         menu_btns = menu.get_btns()
         if self.nav_id < len(menu_btns):
@@ -59,24 +304,16 @@ class Data:
         self._nav_id = nav_id
         menu_btns[self.nav_id].setEnabled(False)
 
-        max_width = content.width() - 50
-        content.clearWidgets()
-        for idx, item in enumerate(main.epub.get_content(nav_id)):
-            if type(item) is epub.Image:
-                label = None
-                try:
-                    label = Image(item, max_width)
-                except KeyError as ke:
-                    label = Text(epub.Text(repr(ke)))
-            elif type(item) is epub.Text:
-                label = Text(item)
-            else:  # 只可能是在`get_content`里自己加了新的类型，然而却没在这里更新相关的处理，所以是抛出异常
-                raise TypeError(f'尚未支持的类型 {type(item)}')
-            content.addWidget(label)
-            if idx % 150 == 0 and idx != 0:
-                QApplication.instance().processEvents()
+        ChapterLoader().load(main.epub, nav_id)  # 加载完成后才会更新标题
 
-        main.setWindowTitle(f'{main.epub.navs[nav_id].text} - {os.path.splitext(os.path.basename(self.path))[0]} - EpubReader')
+    def jump(self, nav_id: int, item_id: int):
+        """跳到第nav_id章的第item_id行(`get_content`结果中的下标)"""
+        loader = ChapterLoader()
+        if nav_id == self.nav_id and not loader.loading:
+            EpubContent().scroll_to_item(item_id)
+        else:
+            self.nav_id = nav_id
+            loader.pending_item = item_id
 
     @property
     def styles(self):
@@ -129,15 +366,55 @@ class TextContextMenu(QMenu):
         self.speak_stop_action.triggered.connect(self.speak_stop)
         self.addAction(self.speak_start_action)
         self.addAction(self.speak_stop_action)
+        self.addSeparator()
+        self.prerender_loaded = False
+        self.prerender_chapter_action = QAction('预先合成本章语音')
+        self.prerender_chapter_action.triggered.connect(lambda: self.prerender_start(1))
+        self.prerender_rest_action = QAction('预先合成本章及之后的语音')
+        self.prerender_rest_action.triggered.connect(lambda: self.prerender_start(None))
+        self.prerender_stop_action = QAction('停止预先合成')
+        self.prerender_stop_action.triggered.connect(self.prerender_stop)
+        self.addAction(self.prerender_chapter_action)
+        self.addAction(self.prerender_rest_action)
+        self.addAction(self.prerender_stop_action)
+
+    def prerender_start(self, count: Optional[int]):
+        """从当前章节开始预先合成count章的语音到缓存, None表示到最后一章"""
+        main = MainWindow()
+        prerenderer = Prerenderer()
+        if prerenderer.isRunning():
+            return
+        if not self.prerender_loaded:
+            prerenderer.progress_signal.connect(self.prerender_progress)
+            prerenderer.finished.connect(self.prerender_finished)
+        self.prerender_loaded = True
+        nav_id = Data().nav_id
+        end = len(main.epub.navs) if count is None else min(nav_id + count, len(main.epub.navs))
+        prerenderer.init(Data().path, list(range(nav_id, end)))
+        EpubContent().set_status('预先合成语音: 准备中...')
+        prerenderer.start()
+
+    def prerender_stop(self):
+        if self.prerender_loaded:
+            Prerenderer().stop()
+
+    def prerender_progress(self, done: int, total: int):
+        EpubContent().set_status(f'预先合成语音: {done}/{total}')
+
+    def prerender_finished(self):
+        EpubContent().set_status('')
 
     def speak_start(self):
         speaker = Speaker()
 
         if not self.speak_loaded:
-            speaker.scroll_signal.connect(lambda height: EpubContent().verticalScrollBar().setValue(height))
+            speaker.scroll_signal.connect(EpubContent().scroll_to_text)  # 连到QObject的方法上, 信号才会排队回到GUI线程处理
         self.speak_loaded = True
 
-        speaker.init(self.text_id, EpubContent().texts)
+        if speaker.isRunning():  # 上一次朗读还没收尾, 等它结束, 不然start不会生效
+            speaker.stop()
+            speaker.wait()
+        speaker.init(self.text_id, [text.text for text in EpubContent().texts])
         speaker.start()
 
     def speak_stop(self):
@@ -154,98 +431,314 @@ class TextContextMenu(QMenu):
                 self.speak_stop_action.setEnabled(True)
         else:
             self.speak_stop_action.setEnabled(False)
+        prerendering = self.prerender_loaded and Prerenderer().isRunning()
+        self.prerender_chapter_action.setEnabled(not prerendering)
+        self.prerender_rest_action.setEnabled(not prerendering)
+        self.prerender_stop_action.setEnabled(prerendering)
         return super().show()
 
 
-class Image(QLabel):
-    def __init__(self, image: epub.Image, max_width: int):
-        super().__init__()
-        self.idx = 0
-        self.src = image.src
-        self.init_image(max_width)
-
-    def init_image(self, max_width: int):
-        """初始化图片，主要是为了以后能随着窗口大小的变化而缩放图片"""
-        main = MainWindow()
-        pixmap = QPixmap.fromImage(QImage.fromData(main.epub.read(self.src)))
-        if pixmap.width() > max_width:
-            pixmap = pixmap.scaledToWidth(max_width, Qt.SmoothTransformation)
-        self.setPixmap(pixmap)
-
-    def contextMenuEvent(self, event: QContextMenuEvent) -> None:
-        menu = ImageContextMenu()
-        menu.image_id = self.idx
-        menu.move(event.globalPos())
-        menu.show()
-
-
-class Text(QLabel):
-    def __init__(self, text: epub.Text) -> None:
-        super().__init__(text.text)
-        self.idx = 0
-        self.setWordWrap(True)
-
-        font = self.font()
-        if text.header_level != epub.Text.HeaderLevel.none:
-            font.setPointSize(14 + 2 * (4 - text.header_level))
-        if text.strong:
-            font.setBold(True)
-        self.setFont(font)
-        del font
-        if text.align == epub.Text.Align.center:
-            self.setAlignment(Qt.AlignCenter)
-        elif text.align == epub.Text.Align.right:
-            self.setAlignment(Qt.AlignRight)
-        if text.color:
-            self.setStyleSheet(f'color: {text.color};')
-
-    def contextMenuEvent(self, event: QContextMenuEvent) -> None:
-        menu = TextContextMenu()
-        menu.text_id = self.idx
-        menu.move(event.globalPos())
-        menu.show()
-
-
 @singleton
-class EpubContent(ScrollArea):
-    """放置epub文件内容的控件"""
+class EpubContent(QAbstractScrollArea):
+    """
+    放置epub文件内容的控件\n
+    不再为每段文字/每张图片各创建一个QLabel, 而是只记下每一行的高度, 绘制时只画视口内可见的那几行\n
+    改变大小时先防抖, 然后只重排可见的几行, 其余的行在之后的事件循环里分批重排, 再次改变大小会取消没排完的部分
+    """
+    margin = 10  # 内容左右的留白
+    spacing = 6  # 行与行之间的间距
+    resize_delay = 80  # 防抖的等待时间(毫秒)
+    relayout_slice = 0.008  # 分批重排时每批最多占用的时间(秒)
+
     def __init__(self, parent: Optional[QWidget] = None):
         super().__init__(parent)
-        self.texts: List[Text] = []
-        self.images: List[Image] = []
-        self._resize_finished = False
-
-    def addWidget(self, widget: QLabel):
-        if type(widget) is Text:
-            widget.idx = len(self.texts)
-            self.texts.append(widget)
-        elif type(widget) is Image:
-            widget.idx = len(self.images)
-            self.images.append(widget)
-        return super().addWidget(widget)
-
-    def clearWidgets(self):
+        self.items: List[Union[epub.Text, epub.Image]] = []
+        self.texts: List[epub.Text] = []  # 朗读和右键菜单按这里的编号来
+        self.images: List[epub.Image] = []
+        self._text_rows: List[int] = []  # texts中每一项在items中的行号
+        self._image_rows: List[int] = []
+        self._heights: List[int] = []  # 每一行的高度(不含行间距)
+        self._offsets: List[int] = [0]  # 每一行顶部的y坐标, 最后多出来的一个是总高度
+        self._width = 0  # 排版时所用的内容宽度
+        self._relayout_queue: List[int] = []  # 还没按新宽度重排的行
+        self._relayout_generation = 0  # 每次开始重排都+1, 旧的分批任务发现对不上就退出
+        self._resize_timer = QTimer(self)
+        self._resize_timer.setSingleShot(True)
+        self._resize_timer.setInterval(self.resize_delay)
+        self._resize_timer.timeout.connect(self._relayout)
+        self._loading_label = QLabel('加载中...', self)
+        self._loading_label.setStyleSheet('padding: 4px 8px; background: palette(mid); border-radius: 4px;')
+        self._loading_label.hide()
+        self._status_label = QLabel(self)  # 右下角的状态, 比如预先合成语音的进度
+        self._status_label.setStyleSheet(self._loading_label.styleSheet())
+        self._status_label.hide()
+        self._fonts: Dict[Tuple[int, bool], QFont] = {}
+        ImageDecoder().decoded.connect(self._image_decoded)
+        QPixmapCache.setCacheLimit(128 << 10)  # 缩放好的图片最多占128MB (单位是KB)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.verticalScrollBar().setSingleStep(20)
+
+    def addItems(self, items: List[Union[epub.Text, epub.Image]]):
+        """在末尾追加内容"""
+        if not self.items:
+            self._width = self.content_width()
+        for item in items:
+            row = len(self.items)
+            if type(item) is epub.Text:
+                self._text_rows.append(row)
+                self.texts.append(item)
+            elif type(item) is epub.Image:
+                self._image_rows.append(row)
+                self.images.append(item)
+            else:  # 只可能是在`get_content`里自己加了新的类型，然而却没在这里更新相关的处理，所以是抛出异常
+                raise TypeError(f'尚未支持的类型 {type(item)}')
+            self.items.append(item)
+            self._heights.append(self._row_height(item, self._width))
+            self._offsets.append(self._offsets[-1] + self._heights[-1] + self.spacing)
+        self._update_scroll_range()
+        self.viewport().update()
+
+    def clearItems(self):
+        self.items = []
         self.texts = []
         self.images = []
-        return super().clearWidgets()
+        self._text_rows = []
+        self._image_rows = []
+        self._heights = []
+        self._offsets = [0]
+        self._relayout_queue = []
+        self._relayout_generation += 1
+        self._update_scroll_range()
+        self.verticalScrollBar().setValue(0)
+        self.viewport().update()
+
+    def set_loading(self, loading: bool):
+        """显示/隐藏右上角的加载提示"""
+        self._loading_label.setVisible(loading)
+        self._place_labels()
+
+    def set_status(self, text: str):
+        """在右下角显示状态, 空字符串则隐藏"""
+        self._status_label.setText(text)
+        self._status_label.setVisible(bool(text))
+        self._place_labels()
+
+    def _place_labels(self):
+        for label in (self._loading_label, self._status_label):
+            label.adjustSize()
+            label.raise_()
+        self._loading_label.move(self.width() - self._loading_label.width() - 30, 10)
+        self._status_label.move(self.width() - self._status_label.width() - 30, self.height() - self._status_label.height() - 10)
+
+    def content_width(self) -> int:
+        return max(self.viewport().width() - 2 * self.margin, 1)
+
+    def row_at(self, y: int) -> int:
+        """视口中y坐标处是第几行, 没有则返回-1"""
+        row = bisect_right(self._offsets, y + self.verticalScrollBar().value()) - 1
+        return row if row < len(self.items) else -1
+
+    def scroll_to_text(self, text_id: int):
+        """滚动到第text_id段文字(稍微往上留一点)"""
+        if 0 <= text_id < len(self._text_rows):
+            self.verticalScrollBar().setValue(self._offsets[self._text_rows[text_id]] - 50)
+
+    def scroll_to_item(self, row: int):
+        """滚动到第row行(稍微往上留一点)"""
+        if 0 <= row < len(self.items):
+            self.verticalScrollBar().setValue(self._offsets[row] - 50)
+
+    def text_font(self, text: epub.Text) -> QFont:
+        key = (text.header_level, text.strong)
+        if key not in self._fonts:
+            font = QFont(self.font())
+            if text.header_level != epub.Text.HeaderLevel.none:
+                font.setPointSize(14 + 2 * (4 - text.header_level))
+            if text.strong:
+                font.setBold(True)
+            self._fonts[key] = font
+        return self._fonts[key]
+
+    @staticmethod
+    def text_flags(text: epub.Text) -> int:
+        if text.align == epub.Text.Align.center:
+            align = Qt.AlignHCenter
+        elif text.align == epub.Text.Align.right:
+            align = Qt.AlignRight
+        else:
+            align = Qt.AlignLeft
+        return int(align) | int(Qt.AlignTop) | int(Qt.TextWordWrap)
+
+    def image_size(self, src: str, width: int) -> QSize:
+        """图片显示时的大小, 太宽的话缩放到width"""
+        size = self.intrinsic_size(src)
+        if size.width() > width:
+            size = QSize(width, size.height() * width // size.width())
+        return size
+
+    def intrinsic_size(self, src: str) -> QSize:
+        """图片原本的尺寸, 只读取并解析图片头, 不解码整张图"""
+        main = MainWindow()
+        size = ImageCache().image_size(main.epub.epub_path, src)
+        if size is None:
+            image = ImageCache().get(main.epub.epub_path, src)
+            if image is not None:
+                size = image.size()
+            else:
+                size = self._read_image_size(main.epub.read_prefix(src, 64 << 10))
+                if not size.isValid():  # 图片头太长(比如jpg里塞了很大的exif)
+                    size = self._read_image_size(main.epub.read(src))
+                if not size.isValid():
+                    size = QSize(0, 0)
+            ImageCache().set_image_size(main.epub.epub_path, src, size)
+        return size
+
+    @staticmethod
+    def _read_image_size(data: bytes) -> QSize:
+        buffer = QBuffer()
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.ReadOnly)
+        return QImageReader(buffer).size()
+
+    def _pixmap_key(self, src: str, size: QSize) -> str:
+        return f'{MainWindow().epub.epub_path}|{src}|{size.width()}x{size.height()}'
+
+    def _row_height(self, item: Union[epub.Text, epub.Image], width: int) -> int:
+        if type(item) is epub.Text:
+            return QFontMetrics(self.text_font(item)).boundingRect(QRect(0, 0, width, 1 << 24), self.text_flags(item), item.text).height()
+        return self.image_size(item.src, width).height()
+
+    def _request_images(self, top: int, bottom: int):
+        """[top, bottom)范围内还没有缩放好的图片交给ImageDecoder去解码"""
+        row = max(bisect_right(self._offsets, top) - 1, 0)
+        while row < len(self.items) and self._offsets[row] < bottom:
+            item = self.items[row]
+            if type(item) is epub.Image:
+                size = self.image_size(item.src, self._width)  # 重排还没排到的行高度可能是旧的, 所以不从_offsets里算
+                key = self._pixmap_key(item.src, size)
+                if size.height() > 0 and QPixmapCache.find(key) is None:
+                    ImageDecoder().request(MainWindow().epub, item.src, size, key)
+            row += 1
+
+    def _image_decoded(self, generation: int, key: str, src: str, original: QSize, image: QImage):
+        ImageDecoder().done(key, generation)
+        main = MainWindow()
+        if main.epub is None or not key.startswith(f'{main.epub.epub_path}|'):  # 已经换书了
+            return
+        if original != self.intrinsic_size(src):  # 图片头里读出来的尺寸不对, 以解码结果为准
+            ImageCache().set_image_size(main.epub.epub_path, src, original)
+            self._relayout()
+        elif not image.isNull():
+            QPixmapCache.insert(key, QPixmap.fromImage(image))
+        self.viewport().update()
+
+    def _relayout(self):
+        """宽度变了, 先重新计算视口内那几行的高度, 剩下的交给`_relayout_batch`分批处理"""
+        self._relayout_generation += 1
+        self._width = self.content_width()
+        anchor, delta = self._anchor()
+        row, bottom = anchor, self.viewport().height() + delta
+        while row < len(self.items) and bottom > 0:
+            self._heights[row] = self._row_height(self.items[row], self._width)
+            bottom -= self._heights[row] + self.spacing
+            row += 1
+        # 从队尾取: 先从近到远排下面的, 再从近到远排上面的
+        self._relayout_queue = list(range(anchor)) + list(range(len(self.items) - 1, row - 1, -1))
+        self._apply_heights(anchor, delta)
+        if self._relayout_queue:
+            generation = self._relayout_generation
+            QTimer.singleShot(0, lambda: self._relayout_batch(generation))
+
+    def _relayout_batch(self, generation: int):
+        if generation != self._relayout_generation:  # 又改变大小了, 或者已经换章节了
+            return
+        anchor, delta = self._anchor()
+        deadline = time.perf_counter() + self.relayout_slice
+        while self._relayout_queue and time.perf_counter() < deadline:
+            row = self._relayout_queue.pop()
+            self._heights[row] = self._row_height(self.items[row], self._width)
+        self._apply_heights(anchor, delta)
+        if self._relayout_queue:
+            QTimer.singleShot(0, lambda: self._relayout_batch(generation))
+
+    def _anchor(self) -> Tuple[int, int]:
+        """当前视口顶部是第几行, 以及视口顶部在这一行内的偏移"""
+        value = self.verticalScrollBar().value()
+        row = min(max(bisect_right(self._offsets, value) - 1, 0), max(len(self.items) - 1, 0))
+        return row, value - self._offsets[row]
+
+    def _apply_heights(self, anchor: int, delta: int):
+        """根据_heights重新计算每一行的位置, 并让anchor这一行保持在原来的位置"""
+        self._offsets = [0]
+        self._offsets.extend(accumulate(height + self.spacing for height in self._heights))
+        self._update_scroll_range()
+        if anchor < len(self.items):
+            self.verticalScrollBar().setValue(self._offsets[anchor] + min(delta, self._heights[anchor]))
+        self.viewport().update()
+
+    def _update_scroll_range(self):
+        bar = self.verticalScrollBar()
+        bar.setPageStep(self.viewport().height())
+        bar.setRange(0, max(self._offsets[-1] - self.viewport().height(), 0))
+
+    def paintEvent(self, event: QPaintEvent) -> None:
+        painter = QPainter(self.viewport())
+        top = self.verticalScrollBar().value()
+        bottom = top + self.viewport().height()
+        row = max(bisect_right(self._offsets, top) - 1, 0)
+        while row < len(self.items) and self._offsets[row] < bottom:
+            item = self.items[row]
+            rect = QRect(self.margin, self._offsets[row] - top, self._width, self._heights[row])
+            if type(item) is epub.Text:
+                color = QColor(item.color) if item.color else QColor()
+                painter.setFont(self.text_font(item))
+                painter.setPen(color if color.isValid() else self.palette().color(QPalette.Text))
+                painter.drawText(rect, self.text_flags(item), item.text)
+            else:
+                rect.setSize(self.image_size(item.src, self._width))  # 重排还没排到的行高度可能是旧的, 所以不用_heights
+                if rect.isEmpty():
+                    row += 1
+                    continue
+                pixmap = QPixmapCache.find(self._pixmap_key(item.src, rect.size()))
+                if pixmap is not None:
+                    painter.drawPixmap(rect.topLeft(), pixmap)
+                else:  # 还没解码, 先画个占位框
+                    painter.setPen(self.palette().color(QPalette.Mid))
+                    painter.drawRect(rect.adjusted(0, 0, -1, -1))
+            row += 1
+        # 先解码可见的, 再解码上下各一屏以内的
+        self._request_images(top, bottom)
+        self._request_images(top - self.viewport().height(), bottom + self.viewport().height())
 
     def resizeEvent(self, event: QResizeEvent) -> None:
-        if not self._resize_finished:
-            self._resize_finished = True
-            max_width = event.size().width() - 50
-            for image in self.images:
-                image.init_image(max_width)
-            for text in self.texts:
-                text.setFixedWidth(max_width)  # 裁剪掉无法换行的长串英文字符，反正通常都是一个超长的破折号或者等号或者链接之类的
-            QTimer.singleShot(100, lambda: setattr(self, '_resize_finished', False))  # 为了防止resizeEvent被多次触发，这里延迟一下
-        return super().resizeEvent(event)
+        super().resizeEvent(event)
+        self._update_scroll_range()
+        self._place_labels()
+        if self.content_width() != self._width:
+            self._relayout_generation += 1  # 取消还没排完的部分
+            self._resize_timer.start()  # 停下来resize_delay毫秒后才真正重排
+
+    def contextMenuEvent(self, event: QContextMenuEvent) -> None:
+        row = self.row_at(event.pos().y())
+        if row == -1:
+            return
+        if type(self.items[row]) is epub.Text:
+            menu = TextContextMenu()
+            menu.text_id = bisect_right(self._text_rows, row) - 1
+        else:
+            menu = ImageContextMenu()
+            menu.image_id = bisect_right(self._image_rows, row) - 1
+        menu.move(event.globalPos())
+        menu.show()
 
 
 class MenuButton(QPushButton):
+    indent = 16  # 目录每深一层多缩进的像素
+
     def __init__(self, nav: epub.Nav) -> None:
         super().__init__(nav.text)
         self.nav_id = nav.index
-        self.setStyleSheet('text-align: left; padding-left: 10px')
+        self.setStyleSheet(f'text-align: left; padding-left: {10 + self.indent * nav.level}px')
         self.clicked.connect(self.nav_shift)
 
     def nav_shift(self):
@@ -290,6 +783,106 @@ class FileInput(QLineEdit):
             self.setText(Data().path)
 
 
+@singleton
+class Searcher(QObject):
+    """在后台线程加载或建立当前书的全文搜索索引, 建好后通过信号交给GUI线程"""
+    built = Signal(int, object)  # generation, SearchIndex
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search')
+        self._generation = 0  # 每次换书都+1, 旧书的索引建到一半就放弃
+        self._book: Optional[epub.Epub] = None  # 正在为哪本书建索引
+        self.index: Optional[SearchIndex] = None
+        self.built.connect(self._on_built)
+
+    def start(self, book: epub.Epub):
+        """每加载完一章都会调用, 同一本书只建一次"""
+        if book is self._book:
+            return
+        self.cancel()
+        self._book = book
+        self._executor.submit(self._build, book, self._generation)
+
+    def cancel(self):
+        self._generation += 1
+        self._book = None
+        self.index = None
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _build(self, book: epub.Epub, generation: int):
+        """在后台线程中运行"""
+        try:
+            index = SearchIndex.load_or_build(book, lambda: generation != self._generation)
+        except Exception as e:
+            if generation == self._generation:  # 换书时旧书被关掉导致的失败不用管
+                print(f'建立搜索索引失败: {e!r}')
+            return
+        if index is not None:
+            self.built.emit(generation, index)
+
+    def _on_built(self, generation: int, index: SearchIndex):
+        if generation != self._generation:
+            return
+        self.index = index
+        SearchBox().index_ready()
+
+
+@singleton
+class SearchBox(QWidget):
+    """全文搜索框, 回车搜索, 点击结果跳转"""
+    max_results = 200
+
+    def __init__(self, parent: Optional[QWidget] = None) -> None:
+        super().__init__(parent)
+        self.input = QLineEdit(self)
+        self.input.setPlaceholderText('搜索全书')
+        self.input.returnPressed.connect(self.search)
+        self.results = QListWidget(self)
+        self.results.setMaximumHeight(200)
+        self.results.itemActivated.connect(self.item_handler)
+        self.results.itemClicked.connect(self.item_handler)
+        self._waiting = False  # 回车时索引还没建好, 建好后要自动搜索
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.input)
+        layout.addWidget(self.results)
+        self.setLayout(layout)
+
+    def search(self):
+        self.results.clear()
+        index = Searcher().index
+        if index is None:
+            self._waiting = True
+            self.results.addItem('正在建立索引...')
+            return
+        self._waiting = False
+        navs = MainWindow().epub.navs
+        hits = index.search(self.input.text(), self.max_results)
+        for nav_id, item_id, snippet in hits:
+            item = QListWidgetItem(f'{navs[nav_id].text}: {snippet}')
+            item.setData(Qt.UserRole, (nav_id, item_id))
+            self.results.addItem(item)
+        if not hits and self.input.text().strip():
+            self.results.addItem('没有找到')
+
+    def index_ready(self):
+        if self._waiting:
+            self.search()
+
+    def clear(self):
+        self._waiting = False
+        self.results.clear()
+
+    def item_handler(self, item: QListWidgetItem):
+        target = item.data(Qt.UserRole)
+        if target is not None:
+            Data().jump(*target)
+
+
 @singleton
 class MainWindow(FileDragable):
     """主窗口"""
@@ -303,11 +896,14 @@ class MainWindow(FileDragable):
 
         self.file_input = FileInput(self)
         self.file_input.hide()
+        self.search_box = SearchBox(self)
+        self.search_box.hide()
         self.menu = Menu(self)
         self.epub_content = EpubContent(self)
 
         layout = QVBoxLayout()
         layout.addWidget(self.file_input)
+        layout.addWidget(self.search_box)
         body = QSplitter()
         body.addWidget(self.menu)
         body.addWidget(self.epub_content)
@@ -330,6 +926,10 @@ class MainWindow(FileDragable):
             Data().style_id += 1
         elif ctrl and key == Qt.Key_I:
             self.file_input.setVisible(not self.file_input.isVisible())
+        elif ctrl and key == Qt.Key_F:
+            self.search_box.setVisible(not self.search_box.isVisible())
+            if self.search_box.isVisible():
+                self.search_box.input.setFocus()
         elif ctrl and key == Qt.Key_N:
             self.menu.setVisible(not self.menu.isVisible())
         elif ctrl and key == Qt.Key_PageUp:
@@ -339,10 +939,15 @@ class MainWindow(FileDragable):
 
     def closeEvent(self, event: QCloseEvent) -> None:
         if TextContextMenu().speak_loaded:
-            speaker = Speaker()
-            speaker.stop()
-            if speaker.process:
-                speaker.process.kill()
+            Speaker().shutdown()
+        if TextContextMenu().prerender_loaded:
+            Prerenderer().shutdown()
+        ChapterLoader().shutdown()
+        Searcher().shutdown()
+        Prefetcher().shutdown()
+        ImageDecoder().shutdown()
+        if self.epub is not None:
+            self.epub.close()
 
 
 if __name__ == '__main__':
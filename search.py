@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+import epub
+
+Hit = Tuple[int, int, str]  # nav编号, 段落在`get_content`结果中的下标, 片段
+
+
+class SearchIndex:
+    """
+    一本书的全文搜索索引, 每段文字(Text)是一篇文档\n
+    中文没有空格可以分词, 所以按字符bigram建倒排表: 查询时对查询串的所有bigram的倒排表求交集得到候选段落, 再在原文里确认并截取片段\n
+    持久化时只存段落列表(和书的索引放在一起, 一起过期), 倒排表在加载时重建, 比存盘再读回来还快
+    """
+    version = 1  # 索引格式有变化时+1
+    snippet_len = 15  # 片段中命中位置前后各保留的字数
+
+    def __init__(self, docs: List[Tuple[int, int, str]]) -> None:
+        self.docs = docs
+        self._lowers = [text.lower() for _, _, text in docs]
+        self.postings: Dict[str, List[int]] = {}
+        for doc_id, text in enumerate(self._lowers):
+            for gram in {text[i:i + 2] for i in range(len(text) - 1)}:
+                posting = self.postings.get(gram)
+                if posting is None:
+                    self.postings[gram] = [doc_id]
+                else:
+                    posting.append(doc_id)
+
+    @staticmethod
+    def build(book: epub.Epub, should_stop: Callable[[], bool] = lambda: False) -> Optional['SearchIndex']:
+        """逐章解析整本书建立索引, 中途`should_stop()`为真时放弃并返回None"""
+        docs: List[Tuple[int, int, str]] = []
+        for nav_id in range(len(book.navs)):
+            for item_id, item in enumerate(book.iter_content(nav_id, cache=False)):  # 扫一遍整本书, 不要挤掉正在读的章节
+                if type(item) is epub.Text and item.text:
+                    docs.append((nav_id, item_id, item.text))
+            if should_stop():
+                return None
+        return SearchIndex(docs)
+
+    @staticmethod
+    def load_or_build(book: epub.Epub, should_stop: Callable[[], bool] = lambda: False) -> Optional['SearchIndex']:
+        """优先读取缓存的索引, 没有或已过期时重新建立并保存"""
+        data = epub.book_index.load(book.epub_path, 'search')
+        if data is not None and data.get('version') == SearchIndex.version:
+            return SearchIndex([tuple(doc) for doc in data['docs']])
+        index = SearchIndex.build(book, should_stop)
+        if index is not None:
+            epub.book_index.save(book.epub_path, {'version': SearchIndex.version, 'docs': index.docs}, 'search')
+        return index
+
+    def search(self, query: str, limit: int = 200) -> List[Hit]:
+        """按书中顺序返回最多limit个命中, 不区分大小写"""
+        query = query.strip().lower()
+        if not query:
+            return []
+        if len(query) == 1:  # 单个字没有bigram, 直接扫一遍也只要几毫秒
+            candidates = range(len(self.docs))
+        else:
+            postings = sorted((self.postings.get(query[i:i + 2], []) for i in range(len(query) - 1)), key=len)
+            matched = set(postings[0])
+            for posting in postings[1:]:
+                if not matched:
+                    break
+                matched.intersection_update(posting)
+            candidates = sorted(matched)
+        hits: List[Hit] = []
+        for doc_id in candidates:
+            pos = self._lowers[doc_id].find(query)  # bigram都在不代表连在一起, 还要确认一下
+            if pos == -1:
+                continue
+            nav_id, item_id, text = self.docs[doc_id]
+            hits.append((nav_id, item_id, self.snippet(text, pos, len(query))))
+            if len(hits) >= limit:
+                break
+        return hits
+
+    @staticmethod
+    def snippet(text: str, pos: int, length: int) -> str:
+        start, end = max(pos - SearchIndex.snippet_len, 0), pos + length + SearchIndex.snippet_len
+        return ('...' if start > 0 else '') + text[start:end] + ('...' if end < len(text) else '')
+
+
+def search_library(paths: List[str], query: str, limit: int = 200) -> Generator[Tuple[str, str, Hit], None, None]:
+    """在多本书中搜索, 产出 (书的路径, 章节名, 命中); 每本书的索引只在第一次搜索时建立"""
+    for path in paths:
+        with epub.Epub(path) as book:
+            index = SearchIndex.load_or_build(book)
+            for hit in index.search(query, limit):
+                yield path, book.navs[hit[0]].text, hit
+
+
+if __name__ == '__main__':
+    # python search.py 关键词 书1 [书2 ...]
+    if len(sys.argv) < 3:
+        print(f'用法: python {os.path.basename(__file__)} 关键词 书1 [书2 ...]')
+        sys.exit(1)
+    begin = time.perf_counter()
+    count = 0
+    for path, nav_text, (nav_id, item_id, snippet) in search_library(sys.argv[2:], sys.argv[1]):
+        print(f'{os.path.basename(path)} | {nav_text} | {snippet}')
+        count += 1
+    print(f'共{count}处, 用时{time.perf_counter() - begin:.3f}s')
@@ -1,17 +1,79 @@
 import asyncio
 import aiohttp
-from hashlib import md5
+from collections import OrderedDict, deque
+from hashlib import sha1
 import json
 import os
-from time import time
-from typing import List, Optional
+from string import Formatter
+import sys
+import threading
+from time import monotonic
+from uuid import uuid4
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, quote_plus
 
-from PySide2.QtWidgets import QLabel
 from PySide2.QtCore import QThread, Signal
 
+import epub
 from utils import MediaPlayer, clean_text_simple, singleton, split_long_text
 
 
+class Template:
+    """
+    config.json里带{text}的字符串模板, 加载时编译一次, 之后每句话只是一次join\n
+    只认{text}这一个占位符(字面的大括号写成{{ }}), 书里的引号、大括号之类不会被当成代码执行; quote用来对text做转义
+    """
+    def __init__(self, template: str, quote: Optional[Callable[[str], str]] = None) -> None:
+        self.template = template
+        self.quote = quote
+        self._literals = ['']  # 占位符之间的字面量, 渲染时用text把它们连起来
+        for literal, field, spec, conversion in Formatter().parse(template):
+            self._literals[-1] += literal
+            if field is None:
+                continue
+            if field != 'text' or spec or conversion:
+                raise ValueError(f'模板中只能使用{{text}}占位符: {template}')
+            self._literals.append('')
+
+    def __call__(self, text: str) -> str:
+        if len(self._literals) == 1:
+            return self._literals[0]
+        return (self.quote(text) if self.quote else text).join(self._literals)
+
+    def __repr__(self) -> str:
+        return f'Template({self.template!r})'
+
+
+class JsonTemplate:
+    """json的请求体模板, 其中所有字符串都当作`Template`, 发送时由aiohttp编码, 所以text不需要额外转义"""
+    def __init__(self, template: Any) -> None:
+        self.template = template
+        self._compiled = JsonTemplate._compile(template)
+
+    @staticmethod
+    def _compile(value: Any) -> Any:
+        if isinstance(value, str):
+            return Template(value)
+        if isinstance(value, dict):
+            return {k: JsonTemplate._compile(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [JsonTemplate._compile(v) for v in value]
+        return value
+
+    @staticmethod
+    def _render(value: Any, text: str) -> Any:
+        if isinstance(value, Template):
+            return value(text)
+        if isinstance(value, dict):
+            return {k: JsonTemplate._render(v, text) for k, v in value.items()}
+        if isinstance(value, list):
+            return [JsonTemplate._render(v, text) for v in value]
+        return value
+
+    def __call__(self, text: str) -> Any:
+        return JsonTemplate._render(self._compiled, text)
+
+
 @singleton
 class SpeakerData:
     def __init__(self) -> None:
@@ -23,8 +85,28 @@ class SpeakerData:
         self.model: str = data['local']['model']
         self.config: str = data['local']['config']
         self.speaker: int = data['local']['speaker']
+        self.moegoe_timeout: float = data['local'].get('timeout', 120)
+        self.moegoe_workers: int = data['local'].get('workers', 1)
         self._url: str = data['online']['url']
-        del data
+        self._body: Any = data['online'].get('body')  # 字符串按表单转义, dict/list按json发送
+        self.method: str = data['online'].get('method', 'POST' if self._body is not None else 'GET').upper()
+        self.headers: Dict[str, str] = data['online'].get('headers', {})
+        self._url_template = Template(self._url, lambda text: quote(text, safe=''))
+        if self._body is None:
+            self._body_template = None
+        elif isinstance(self._body, str):
+            self._body_template = Template(self._body, quote_plus)
+        else:
+            self._body_template = JsonTemplate(self._body)
+        self.concurrency: int = max(1, data['online'].get('concurrency', 3))
+        self.timeout: float = data['online'].get('timeout', 30)
+        self.retries: int = data['online'].get('retries', 3)
+        speak = data.get('speak', {})  # 兼容没有speak项的旧配置文件
+        self.lookahead: int = max(1, speak.get('lookahead', 3))
+        self.cache_mb: int = speak.get('cache_mb', 512)
+        self.split_len: int = speak.get('split_len', 25)
+        self.split_max: int = speak.get('split_max', 60)
+        del data, speak
 
     def __str__(self) -> str:
         if self.local:
@@ -35,190 +117,745 @@ class SpeakerData:
             raise ValueError('method not in (local, online)')
 
     def url(self, text: str) -> str:
-        return eval(f'f"{self._url}"')
+        return self._url_template(text)
+
+    def request(self, text: str) -> Tuple[str, str, dict]:
+        """合成text的HTTP请求: (method, url, 传给aiohttp的其他参数)"""
+        kwargs: dict = {'headers': self.headers} if self.headers else {}
+        if isinstance(self._body_template, JsonTemplate):
+            kwargs['json'] = self._body_template(text)
+        elif self._body_template is not None:
+            kwargs['data'] = self._body_template(text)
+            if not any(k.lower() == 'content-type' for k in self.headers):  # 字符串的body是按表单转义的
+                kwargs['headers'] = {**self.headers, 'Content-Type': 'application/x-www-form-urlencoded'}
+        return self.method, self.url(text), kwargs
+
+    def backend(self) -> list:
+        """决定合成结果的全部参数, 任何一项变了之前合成的音频就不能再用"""
+        if self.local:
+            return ['local', self.model, self.config, self.speaker]
+        elif self.online:
+            return ['online', self.method, self._url, self._body]
+        else:
+            raise ValueError('method not in (local, online)')
+
+
+class Downloader:
+    """
+    在线合成用的HTTP客户端\n
+    整个朗读期间复用同一个session(keep-alive, 限制连接数), 响应边下边写盘, 出错时按指数退避重试
+    """
+    chunk_size = 64 << 10
+
+    def __init__(self, concurrency: int = 3, timeout: float = 30, retries: int = 3) -> None:
+        self.concurrency = concurrency  # 同时进行的请求数, 多出来的请求会排队等连接
+        self.timeout = timeout
+        self.retries = retries
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """session要在事件循环里创建, 所以第一次下载时才创建"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=min(10, self.timeout)),
+            )
+        return self._session
+
+    async def download(self, url: str, path: str, method: str = 'GET', **kwargs):
+        """kwargs原样传给`aiohttp.ClientSession.request`(headers, json, data之类)"""
+        session = self._get_session()
+        part_path = f'{path}.{uuid4().hex}.part'  # 每次下载各用各的临时文件, 同一个path同时被下载也不会互相覆盖
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with session.request(method, url, **kwargs) as res:
+                        res.raise_for_status()
+                        with open(part_path, 'wb') as file:
+                            async for chunk in res.content.iter_chunked(self.chunk_size):
+                                file.write(chunk)
+                    os.replace(part_path, path)  # 下完了才出现在path, 不会播放到半截的文件
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status != 429:
+                        raise  # 请求本身有问题, 重试也没用
+                    if attempt == self.retries:
+                        raise
+                    delay = 0.5 * (1 << attempt)
+                    print(f'下载音频失败, {delay}秒后重试: {e!r}')
+                    await asyncio.sleep(delay)
+        finally:
+            if os.path.exists(part_path):  # 失败或被取消, 下了一半的不要留着
+                os.remove(part_path)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+@singleton
+class AudioCache:
+    """
+    合成好的音频的磁盘缓存, 文件名是 (合成方式的参数, 清洗后的文字) 的哈希, 同一句话再读一遍就直接播放\n
+    按文件大小做LRU淘汰, 使用顺序记录在index.json里
+    """
+    version = 1  # 索引格式有变化时+1, 旧的索引就会作废
+    flush_interval = 1.0  # 登记新音频后最多隔这么多秒写一次index.json
+
+    def __init__(self, cache_dir: str = os.path.join('cache', 'audio')) -> None:
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = SpeakerData().cache_mb << 20
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._data: 'OrderedDict[str, int]' = OrderedDict()  # 键 -> 文件大小, 越靠后越是最近用过的
+        self._dirty = False
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return sha1(json.dumps(SpeakerData().backend() + [text], ensure_ascii=False).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.wav')
+
+    def temp_path(self, key: str) -> str:
+        """合成中的临时文件, 每次调用都不一样; 合成到一半被打断留下的会在下次启动时删掉(不在索引里)"""
+        return os.path.join(self.cache_dir, f'{key}.{uuid4().hex}.part.wav')
+
+    def get(self, key: str) -> Optional[str]:
+        """命中时返回音频路径"""
+        with self._lock:
+            if key in self._data:
+                if os.path.isfile(self.path(key)):
+                    self.hits += 1
+                    self._data.move_to_end(key)
+                    self._dirty = True
+                    return self.path(key)
+                self._size -= self._data.pop(key)  # 文件被删掉了
+            self.misses += 1
+            return None
+
+    def __contains__(self, key: str) -> bool:
+        """只看在不在缓存里, 不算命中/未命中, 也不影响淘汰顺序"""
+        with self._lock:
+            return key in self._data and os.path.isfile(self.path(key))
+
+    def put(self, key: str):
+        """音频已经写到了`path(key)`, 登记进索引"""
+        try:
+            size = os.path.getsize(self.path(key))
+        except OSError:
+            return
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)
+            self._data[key] = size
+            self._size += size
+            while self._size > self.max_bytes and len(self._data) > 1:  # 刚放进来的这个不淘汰
+                old_key, old_size = self._data.popitem(last=False)
+                self._size -= old_size
+                try:
+                    os.remove(self.path(old_key))
+                except OSError:
+                    pass  # 可能正在播放, 留着也无所谓, 不在索引里了
+            self._dirty = True
+        if monotonic() - self._flushed_at > self.flush_interval:  # 批量合成时每段都写一次索引太慢了
+            self.flush()
+
+    def flush(self):
+        """把使用顺序写回index.json; 朗读和预先合成两个线程都会调用, 整个写入过程都持有锁"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._flushed_at = monotonic()
+            try:
+                tmp_path = os.path.join(self.cache_dir, 'index.json.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as file:
+                    json.dump({'version': self.version, 'entries': list(self._data.items())}, file, separators=(',', ':'))
+                os.replace(tmp_path, os.path.join(self.cache_dir, 'index.json'))  # 先写临时文件再替换, 中途出错也不会留下坏的索引
+            except OSError as e:  # 写不了索引也不影响朗读
+                print(f'保存音频缓存索引失败: {e!r}')
+
+    def _load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        loaded = True  # 索引读不出来时不知道哪些音频是有用的, 一个都不删
+        try:
+            with open(os.path.join(self.cache_dir, 'index.json'), 'r', encoding='utf-8') as file:
+                index = json.load(file)
+            if index.get('version') == self.version:
+                for key, size in index['entries']:
+                    self._data[key] = size
+                    self._size += size
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            print(f'读取音频缓存索引失败: {e!r}')
+            self._data.clear()
+            self._size = 0
+            loaded = False
+        for name in os.listdir(self.cache_dir):  # 合成/下载到一半被取消的文件不在索引里, 顺手删掉
+            if name.endswith(('.part', '.part.wav')) or loaded and name.endswith('.wav') and name[:-4] not in self._data:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    @property
+    def size(self) -> int:
+        """当前缓存占用的磁盘空间(字节)"""
+        return self._size
+
+    def __str__(self) -> str:
+        return f'AudioCache(items={len(self._data)}, size={self._size}, hits={self.hits}, misses={self.misses})'
+
+
+class MoeGoe:
+    """
+    与一个MoeGoe子程序的交互: 等它输出提示, 再输入对应的内容\n
+    提示用`StreamReader.readuntil`在缓冲区里增量查找, 每一步都有超时; 朗读者列表只在第一轮解析和打印, 之后直接跳过
+    """
+    err_msg = '与MoeGoe的交互出现了不认识的输出，请确认MoeGoe版本或是否报错'
+    stdout_limit = 4 << 20  # 缓冲区里读了这么多还没等到提示, 肯定是出问题了
+
+    def __init__(self, exe: str, model: str, config: str, speaker: int, timeout: float = 120) -> None:
+        self.exe = exe
+        self.model = model
+        self.config = config
+        self.speaker = speaker
+        self.timeout = timeout  # 每一步等待提示的超时(秒), 合成长句时也要在这个时间内完成
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.speakers: Optional[Dict[int, str]] = None  # 朗读者列表 ID -> 名字
+
+    async def _expect(self, prompt: bytes, echo: bool = True) -> bytes:
+        """读到prompt为止, 返回读到的全部内容(包括prompt)"""
+        try:
+            data = await asyncio.wait_for(self.process.stdout.readuntil(prompt), self.timeout)
+        except asyncio.IncompleteReadError as e:  # MoeGoe退出了, 多半是报错了
+            print(e.partial.decode('gbk', errors='replace'))
+            raise RuntimeError(self.err_msg) from None
+        except asyncio.LimitOverrunError:
+            raise RuntimeError(self.err_msg) from None
+        except asyncio.TimeoutError:
+            raise RuntimeError(f'等待MoeGoe输出 {prompt.decode()!r} 超时') from None
+        if echo:
+            print(data.decode('gbk', errors='replace'), end='')
+        return data
+
+    async def _send(self, line: str, encoding: str = 'utf-8'):
+        print(line)
+        self.process.stdin.write(f'{line}\n'.encode(encoding, errors='ignore'))
+        await self.process.stdin.drain()
+
+    async def _start(self):
+        """创建子程序, 输入model和config"""
+        print('正在创建与MoeGoe交互的子程序...')
+        try:
+            self.process = await asyncio.create_subprocess_exec(  # 不经过shell, 否则kill只能杀掉shell, MoeGoe本身还在
+                self.exe,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=self.stdout_limit,
+            )
+        except OSError as e:
+            raise RuntimeError(f'无法启动MoeGoe {self.exe!r}: {e}') from None
+        print('开始初始化MoeGoe...')
+        await self._expect(b'Path of a VITS model: ')
+        await self._send(self.model)
+        await self._expect(b'Path of a config file: ')
+        await self._send(self.config)
+        print('MoeGoe配置完成')
+
+    async def synthesize(self, text: str, path: str):
+        """把text合成到path, 中途出错或被取消时MoeGoe的状态就对不上了, 直接关掉, 下次重开"""
+        try:
+            await self._synthesize(text, path)
+        except BaseException:
+            await self.kill()
+            raise
+
+    async def _synthesize(self, text: str, path: str):
+        if self.process is None:
+            await self._start()
+        else:
+            await self._expect(b'Continue? (y/n): ')
+            await self._send('y')
+        await self._expect(b'TTS or VC? (t/v):')
+        await self._send('t')
+        await self._expect(b'Text to read: ')
+        await self._send(text, 'gbk')  # 唯一一个可能出现奇怪字符的地方，errors防止gbk不支持的字符导致报错
+        # ID      Speaker\n0       綾地寧々\n...\nSpeaker ID: (朗读者列表每次都一样, 只在第一次解析)
+        output = await self._expect(b'Speaker ID: ', echo=self.speakers is None)
+        if self.speakers is None:
+            self.speakers = MoeGoe.parse_speakers(output)
+            if self.speakers and self.speaker not in self.speakers:
+                raise ValueError(f'朗读者ID {self.speaker} 不在模型的朗读者列表中: {self.speakers}')
+        else:
+            print('Speaker ID: ', end='')
+        await self._send(str(self.speaker))
+        await self._expect(b'Path to save: ')
+        await self._send(path)
+        await self._expect(b'Successfully saved!')
+
+    @staticmethod
+    def parse_speakers(output: bytes) -> Dict[int, str]:
+        speakers: Dict[int, str] = {}
+        for line in output.decode('gbk', errors='replace').splitlines():
+            parts = line.split(maxsplit=1)
+            if len(parts) == 2 and parts[0].isdigit():
+                speakers[int(parts[0])] = parts[1]
+        return speakers
+
+    def exited(self) -> bool:
+        """子程序是否自己退出了(崩溃之类)"""
+        return self.process is not None and self.process.returncode is not None
+
+    async def kill(self):
+        """关掉子程序并等它真正退出"""
+        if self.process is not None:
+            process, self.process = self.process, None
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+
+class MoeGoePool:
+    """
+    多个MoeGoe子程序同时合成, 每个只在第一次用到时初始化一次model和config\n
+    合成请求交给空闲的子程序; 出错的会被关掉重开, 自己退出了的在下次使用前重开
+    """
+    def __init__(self, size: int, exe: str, model: str, config: str, speaker: int, timeout: float = 120) -> None:
+        self.workers = [MoeGoe(exe, model, config, speaker, timeout) for _ in range(max(1, size))]
+        self._idle: Optional['asyncio.Queue[MoeGoe]'] = None
+
+    async def synthesize(self, text: str, path: str):
+        if self._idle is None:  # 要在朗读线程的事件循环里创建
+            self._idle = asyncio.Queue()
+            for worker in self.workers:
+                self._idle.put_nowait(worker)
+        worker = await self._idle.get()
+        try:
+            if worker.exited():
+                await worker.kill()
+            try:
+                await worker.synthesize(text, path)
+            except RuntimeError as e:  # 出错时MoeGoe已经被关掉了, 重开再试一次
+                print(f'{e}, 重启MoeGoe后重试')
+                await worker.synthesize(text, path)
+        finally:
+            self._idle.put_nowait(worker)
+
+    async def kill(self):
+        await asyncio.gather(*(worker.kill() for worker in self.workers))
+
+
+class Synthesizer:
+    """
+    把文字合成为音频: 分段、清洗、查缓存, 没有缓存时交给配置好的合成方式(在线接口或MoeGoe)\n
+    朗读和预先合成共用这一套, 所以两边合成的是同样的分段, 缓存可以互相用上
+    """
+    def __init__(self) -> None:
+        self.data = SpeakerData()
+        self.cache = AudioCache()
+        self.downloader = Downloader(self.data.concurrency, self.data.timeout, self.data.retries)
+        self.moegoe = MoeGoePool(self.data.moegoe_workers, self.data.moegoe, self.data.model, self.data.config, self.data.speaker, self.data.moegoe_timeout)
+        self._running: Dict[str, List] = {}  # 键 -> [正在合成的future, 等待它的协程数], 同一段同时被请求时只合成一次
+
+    @property
+    def concurrency(self) -> int:
+        """最多同时合成几段"""
+        return self.data.concurrency if self.data.online else len(self.moegoe.workers)
+
+    def chunks(self, text: str) -> List[str]:
+        """把一段文字分成实际送去合成的若干段"""
+        chunks = []
+        for short_text in split_long_text(text, self.data.split_len, self.data.split_max):  # 长文本分割, 不然太慢
+            if self.data.local:
+                short_text = short_text.strip()
+                if not short_text:
+                    continue
+                short_text = clean_text_simple(short_text)
+            elif not self.data.online:
+                raise RuntimeError('未知的语音合成方式')
+            chunks.append(short_text)
+        return chunks
+
+    async def synthesize(self, chunk: str) -> str:
+        """
+        返回chunk的音频路径, 没读过的先合成再放进缓存\n
+        同一段正在合成时(比如"嗯。"在lookahead里出现了两次)直接等那一次的结果; 所有等待者都取消了才取消合成
+        """
+        key = self.cache.key(chunk)
+        path = self.cache.get(key)
+        if path is not None:
+            return path
+        running = self._running.get(key)
+        if running is None:
+            running = self._running[key] = [asyncio.ensure_future(self._synthesize(key, chunk)), 0]
+        running[1] += 1
+        try:
+            return await asyncio.shield(running[0])
+        except asyncio.CancelledError:
+            if running[1] == 1:  # 没有别人在等了
+                running[0].cancel()
+            raise
+        finally:
+            running[1] -= 1
+            if running[1] == 0 and self._running.get(key) is running:
+                del self._running[key]
+
+    async def _synthesize(self, key: str, chunk: str) -> str:
+        path = self.cache.path(key)
+        if self.data.online:
+            method, url, kwargs = self.data.request(chunk)
+            await self.downloader.download(url, path, method, **kwargs)
+        else:
+            temp_path = self.cache.temp_path(key)  # 朗读和预先合成可能同时在合成同一段
+            try:
+                await self.moegoe.synthesize(chunk, temp_path)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        self.cache.put(key)
+        return path
+
+    async def close(self):
+        await self.moegoe.kill()
+        await self.downloader.close()
+
+
+async def prerender(path: str, nav_ids: Iterable[int], synthesizer: Synthesizer,
+                    progress: Optional[Callable[[int, int], None]] = None,
+                    should_stop: Callable[[], bool] = lambda: False) -> Tuple[int, int]:
+    """
+    把书中若干章节的文字预先合成到音频缓存里, 返回 (完成的段数, 总段数)\n
+    已经在缓存里的直接算作完成, 所以中断后再运行会从没合成的地方接着来; progress(完成的段数, 总段数)会在每段完成后调用\n
+    章节逐章在线程池里解析(不进章节缓存, 免得挤掉正在读的章节), 每章之间都可以被取消; `should_stop()`为真时不再开始新的章节和分段
+    """
+    def read_texts(book: epub.Epub, nav_id: int) -> List[str]:
+        return [item.text for item in book.iter_content(nav_id, cache=False) if type(item) is epub.Text]
+
+    loop = asyncio.get_event_loop()
+    chunks: Dict[str, str] = {}  # 键 -> 分段, 重复的句子只合成一次
+    with epub.Epub(path) as book:
+        for nav_id in nav_ids:
+            if should_stop():
+                break
+            for text in await loop.run_in_executor(None, read_texts, book, nav_id):
+                for chunk in synthesizer.chunks(text):
+                    chunks.setdefault(synthesizer.cache.key(chunk), chunk)
+    todo = [chunk for key, chunk in chunks.items() if key not in synthesizer.cache]
+    total = len(chunks)
+    done = total - len(todo)
+    if progress:
+        progress(done, total)
+    semaphore = asyncio.Semaphore(synthesizer.concurrency)
+
+    async def render(chunk: str):
+        nonlocal done
+        async with semaphore:
+            if should_stop():
+                return
+            try:
+                await synthesizer.synthesize(chunk)
+            except (RuntimeError, aiohttp.ClientError, asyncio.TimeoutError) as e:  # 一段失败不影响其他的, 下次运行会再试
+                print(f'合成失败: {chunk} {e!r}')
+                return
+        done += 1
+        if progress:
+            progress(done, total)
+
+    try:
+        await asyncio.gather(*(render(chunk) for chunk in todo))
+    finally:
+        synthesizer.cache.flush()
+    return done, total
+
+
+@singleton
+class Prerenderer(QThread):
+    """在后台线程里运行`prerender`, 给GUI用"""
+    progress_signal = Signal(int, int)  # 完成的段数, 总段数
+
+    def __init__(self):
+        super().__init__()
+        self.path = ''
+        self.nav_ids: List[int] = []
+        self.event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Future] = None
+        self._stopped = False  # stop可能在_task创建之前就来了, 这时取消不了任务, prerender靠这个在章节和分段之间停下
+
+    def init(self, path: str, nav_ids: List[int]):
+        self.path = path
+        self.nav_ids = nav_ids
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+        if self.event_loop is not None and self.event_loop.is_running() and self._task is not None:
+            self.event_loop.call_soon_threadsafe(self._task.cancel)
+
+    async def _main(self):
+        if self._stopped:  # 在start之后、事件循环跑起来之前就stop了
+            print('预先合成已停止')
+            return
+        # 和朗读各用各的, 事件循环不同; 所以本地合成时一边朗读一边预先合成, 会同时开两组MoeGoe(各local.workers个, 每个都加载一份模型)
+        synthesizer = Synthesizer()
+        self._task = asyncio.ensure_future(prerender(self.path, self.nav_ids, synthesizer, self.progress_signal.emit, lambda: self._stopped))
+        try:
+            done, total = await self._task
+            print(f'预先合成已停止: {done}/{total}' if self._stopped else f'预先合成完成: {done}/{total}')
+        except asyncio.CancelledError:
+            print('预先合成已停止')
+        finally:
+            self._task = None
+            await synthesizer.close()
+
+    def run(self):
+        if self.event_loop is None:
+            self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+        self.event_loop.run_until_complete(self._main())
+
+    def shutdown(self):
+        self.stop()
+        self.wait()
 
 
 @singleton
 class Speaker(QThread):
-    scroll_signal = Signal(int)
+    """
+    朗读: 在自己的线程里跑asyncio, 合成和播放是一对生产者/消费者\n
+    播放器属于GUI线程, 两边只通过信号来往: 消费者把音频用`_enqueue_signal`交给GUI线程排队,
+    GUI线程在播放器的stateChanged/mediaStatusChanged里开始下一段并把"播完了"送回事件循环, 不用轮询
+    """
+    scroll_signal = Signal(int)  # 正在朗读的文字编号
+    _enqueue_signal = Signal(int, int, str)  # generation, 文字编号, 音频路径
+    _clear_signal = Signal(int)  # generation
+    queued_clips = 2  # 交给播放器的音频段数: 正在播放的 + 排在后面的, 一段播完马上接下一段
 
     def __init__(self):
         super().__init__()
         self.data = SpeakerData()
-        self.texts: List[QLabel] = []
+        self.texts: List[str] = []
         self.text_id = 0
         self._looping = True
-        self.tmp_path = os.path.abspath('tmp')
-        self.player = MediaPlayer()
+        self._generation = 0  # 每次开始朗读+1, 用来忽略上一次朗读留下的播放事件
+        self.synthesizer = Synthesizer()
         self.event_loop: Optional[asyncio.AbstractEventLoop] = None
-        self.process: Optional[asyncio.subprocess.Process] = None
-        self.err_msg = '与MoeGoe的交互出现了不认识的输出，请确认MoeGoe版本或是否报错'
-
-    def generate_output_path(self, text: str):
-        file_name = md5((str(time()) + text).encode()).hexdigest() + '.wav'
-        return os.path.abspath(os.path.join(self.tmp_path, file_name))
+        self._tasks: List[asyncio.Future] = []  # 合成和播放两个协程, stop时取消
+        self._room: Optional[asyncio.Semaphore] = None  # 还能交给播放器几段, 只在事件循环里用
+        # 以下只在GUI线程里用
+        self.player = MediaPlayer()
+        self.player.stateChanged.connect(self._state_changed)
+        self.player.mediaStatusChanged.connect(self._media_status_changed)
+        self._clips: Deque[Tuple[int, int, str]] = deque()  # 排队等播放的 (generation, 文字编号, 路径)
+        self._current: Optional[Tuple[int, int]] = None  # 正在播放的 (generation, 文字编号)
+        self._announced = False  # 正在播放的这段是否已经发过scroll_signal
+        self._enqueue_signal.connect(self._enqueue)
+        self._clear_signal.connect(self._clear)
 
     def stop(self):
         self._looping = False
+        if self.event_loop is not None and self.event_loop.is_running():
+            self.event_loop.call_soon_threadsafe(self._cancel_tasks)  # stop是在GUI线程里调用的
+
+    def _cancel_tasks(self):
+        if self._looping:  # 已经重新开始朗读了, 这是上一次遗留的取消请求
+            return
+        for task in self._tasks:
+            task.cancel()
 
     def stopped(self) -> bool:
         return not self._looping
 
-    def init(self, text_start_id: int, texts: List[QLabel]):
+    def init(self, text_start_id: int, texts: List[str]):
         self.text_id = text_start_id
         self.texts = texts
         self._looping = True
+        self._generation += 1
 
-    async def _download_wav(self, text: str):
-        """从接口下载音频, 播放"""
-        url = self.data.url(text)
-        path = self.generate_output_path(text)
-        if os.path.exists(self.tmp_path):
-            for name in os.listdir(self.tmp_path):
-                name = os.path.join(self.tmp_path, name)
-                if os.path.isfile(name) and name.endswith('.wav'):
-                    os.remove(name)
-        else:
-            os.mkdir(self.tmp_path)
-        async with aiohttp.ClientSession() as session:
-            res = await session.get(url)
-            content = await res.read()
-        with open(path, 'wb') as file:
-            file.write(content)
-        return await self._play(path)
-
-    async def _generate_wav(self, text: str):
-        """本地语音生成, 播放"""
-        # prepare
-        path = self.generate_output_path(text)
-        if os.path.exists(self.tmp_path):
-            for name in os.listdir(self.tmp_path):
-                name = os.path.join(self.tmp_path, name)
-                if os.path.isfile(name) and name.endswith('.wav'):
-                    try:
-                        os.remove(name)
-                    except:
-                        pass  # 有时候会出现文件被占用的情况，无所谓，下次会删
-        else:
-            os.mkdir(self.tmp_path)
-        # MoeGoe相关
-        if self.process is None:  # 初始化, 输入model和config
-            print('正在创建与MoeGoe交互的子程序...')
-            self.process = await asyncio.subprocess.create_subprocess_shell(
-                f'"{SpeakerData().moegoe}"',
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-            )
-            print('开始初始化MoeGoe...')
-            # Path of a VITS model: {model_path}
-            s = await self.process.stdout.read(128)
-            print(s.decode('gbk'), end='')
-            if s != b'Path of a VITS model: ':
-                raise RuntimeError(self.err_msg)
-            print(self.data.model)
-            self.process.stdin.write(f'{self.data.model}\n'.encode())
-            await self.process.stdin.drain()
-            # Path of a config file: {config_path}
-            s = await self.process.stdout.read(128)
-            print(s.decode('gbk'), end='')
-            if s != b'Path of a config file: ':
-                raise RuntimeError(self.err_msg)
-            print(self.data.config)
-            self.process.stdin.write(f'{self.data.config}\n'.encode())
-            await self.process.stdin.drain()
-            print('MoeGoe配置完成')
-        else:  # Continue? (y/n): y
-            s = await self.process.stdout.read(128)
-            print(s.decode('gbk'), end='')
-            if s != b'Continue? (y/n): ':
-                raise RuntimeError(self.err_msg)
-            print('y')
-            self.process.stdin.write(f'y\n'.encode())
-            await self.process.stdin.drain()
-        if self.process is not None:  # 和MoeGoe的交互
-            # TTS or VC? (t/v):t
-            s = await self.process.stdout.read(128)
-            print(s.decode('gbk'), end='')
-            if s != b'TTS or VC? (t/v):':
-                raise RuntimeError(self.err_msg)
-            print('t')
-            self.process.stdin.write(f't\n'.encode())
-            await self.process.stdin.drain()
-            # Text to read: {text}
-            s = await self.process.stdout.read(128)
-            print(s.decode('gbk'), end='')
-            if s != b'Text to read: ':
-                raise RuntimeError(self.err_msg)
-            print(f'{text}')
-            self.process.stdin.write(f'{text}\n'.encode('gbk', errors='ignore'))  # 唯一一个可能出现奇怪字符的地方，errors防止gbk不支持的字符导致报错
-            await self.process.stdin.drain()
-            # ID      Speaker\n0       綾地寧々\n...\nSpeaker ID: 2(这里麻烦的是speaker是分好几行的，长度也不确定)
-            target = b'Speaker ID: '
-            lst: List[bytes] = []
-            cnt = 0
-            while True:  # 只能1个1个探索了
-                s = await self.process.stdout.read(1)
-                cnt += 1
-                lst.append(s)
-                if b''.join(lst[-len(target):]) == target:
-                    break
-                if cnt > (4 << 20):  # 读了4M个字节了还没找到，总不能真就一直这么找下去吧，而且这也说明肯定出问题了啊
-                    raise RuntimeError(self.err_msg)
-            print(b''.join(lst).decode('gbk'), end='')
-            del lst, target, cnt
-            print(f'{self.data.speaker}')
-            self.process.stdin.write(f'{self.data.speaker}\n'.encode())
-            await self.process.stdin.drain()
-            # Path to save: {output_path}
-            s = await self.process.stdout.read(128)
-            print(s.decode('gbk'), end='')
-            if s != b'Path to save: ':
-                raise RuntimeError(self.err_msg)
-            print(f'{path}')
-            self.process.stdin.write(f'{path}\n'.encode())
-            await self.process.stdin.drain()
-            # Successfully saved! (这里有回车,而且考虑到Continue在前面接收了,所以这里用readline)
-            s = await self.process.stdout.readline()
-            print(s.decode('gbk'), end='')
-            if s.strip() != b'Successfully saved!':
-                raise RuntimeError(self.err_msg)
-        return await self._play(path)
+    def _enqueue(self, generation: int, text_id: int, path: str):
+        """GUI线程: 音频排队, 播放器空着就马上播"""
+        self._clips.append((generation, text_id, path))
+        if self._current is None:
+            self._play_next()
 
-    async def _play(self, path: str):
-        """播放, 并移动到正在播放的句子的位置"""
-        while self.player.state() == MediaPlayer.PlayingState and self._looping:
-            await asyncio.sleep(0.1)  # 等待上一个播放结束
-        if not self._looping:
+    def _clear(self, generation: int):
+        """GUI线程: 朗读停止了, 丢掉还没开始播放的音频, 正在播放的让它播完"""
+        self._clips = deque(clip for clip in self._clips if clip[0] != generation)
+
+    def _play_next(self):
+        """GUI线程: 播放下一段"""
+        if not self._clips:
+            self._current = None
             return
-        # 移动
-        self.scroll_signal.emit(self.texts[self.text_id].y() - 50)
-        # 播放
+        generation, text_id, path = self._clips.popleft()
+        self._current = (generation, text_id)
+        self._announced = False
         self.player.setMedia(path)
         self.player.play()
 
-    async def _main(self):
-        while self._looping:
-            text = self.texts[self.text_id].text()
-            # 语音合成
-            for short_text in split_long_text(text):  # 长文本分割, 不然太慢
-                if not self._looping:  # 虽然不影响外层循环, 但外层也马上会结束, 并且结束前不会出错所以姑且用break
-                    break
-                if self.data.online:
-                    await self._download_wav(short_text)
-                elif self.data.local:
-                    short_text = short_text.strip()
-                    if short_text:
-                        await self._generate_wav(clean_text_simple(short_text))
-                else:
-                    raise RuntimeError('未知的语音合成方式')
-            # 看完后退出
-            self.text_id += 1
-            if self.text_id >= len(self.texts):
+    def _state_changed(self, state: int):
+        """GUI线程: 真正开始播放时才移动到这句话"""
+        if state == MediaPlayer.PlayingState and self._current is not None and not self._announced:
+            self._announced = True
+            self.scroll_signal.emit(self._current[1])
+
+    def _media_status_changed(self, status: int):
+        """GUI线程: 一段播完(或者播不了)就接着播下一段, 并告诉事件循环空出了一个位置"""
+        if status not in (MediaPlayer.EndOfMedia, MediaPlayer.InvalidMedia) or self._current is None:
+            return
+        generation = self._current[0]
+        self._play_next()
+        if self.event_loop is not None and self.event_loop.is_running():
+            self.event_loop.call_soon_threadsafe(self._clip_done, generation)
+
+    def _clip_done(self, generation: int):
+        if generation == self._generation and self._room is not None:
+            self._room.release()
+
+    async def _play(self, path: str):
+        """等播放器有空位了再把音频交给它, 滚动到这句话是在真正开始播放时由GUI线程做的"""
+        await self._room.acquire()
+        self._enqueue_signal.emit(self._generation, self.text_id, path)
+
+    async def _produce(self, queue: 'asyncio.Queue[Optional[Tuple[int, asyncio.Future]]]'):
+        """
+        生产者: 从当前句子开始往后合成, 把 (句子编号, 音频路径的future) 按顺序放进队列, 队列满了就等播放消耗\n
+        合成是并发进行的(在线合成受连接数限制, 本地合成受MoeGoe子程序数限制), 播放顺序由队列保证
+        """
+        text_id = self.text_id
+        while text_id < len(self.texts) and self._looping:
+            for chunk in self.synthesizer.chunks(self.texts[text_id]):
+                await queue.put((text_id, asyncio.ensure_future(self.synthesizer.synthesize(chunk))))
+            text_id += 1
+        await queue.put(None)  # 读完了
+
+    async def _consume(self, queue: 'asyncio.Queue[Optional[Tuple[int, asyncio.Future]]]'):
+        """消费者: 按顺序播放队列里的音频"""
+        while True:
+            item = await queue.get()
+            if item is None or not self._looping:
                 break
-        self.stop()
+            self.text_id, job = item
+            await self._play(await job)
+        for _ in range(self.queued_clips):  # 等最后几段播完
+            await self._room.acquire()
+
+    async def _main(self):
+        if not self._looping:  # 在start之后、事件循环跑起来之前就stop了, 这时候stop取消不了任务
+            return
+        queue: 'asyncio.Queue[Optional[Tuple[int, asyncio.Future]]]' = asyncio.Queue(maxsize=self.data.lookahead)  # 最多提前合成这么多段
+        self._room = asyncio.Semaphore(self.queued_clips)
+        producer = asyncio.ensure_future(self._produce(queue))
+        consumer = asyncio.ensure_future(self._consume(queue))
+        self._tasks = [producer, consumer]
+        try:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            while not queue.empty():  # 还没轮到播放的下载也取消掉
+                item = queue.get_nowait()
+                if item is not None:
+                    self._tasks.append(item[1])
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+            self._room = None
+            self._clear_signal.emit(self._generation)
+            self._looping = False
+            self.synthesizer.cache.flush()
+        if not producer.cancelled() and producer.exception() is not None:
+            raise producer.exception()
+        if not consumer.cancelled() and consumer.exception() is not None:
+            raise consumer.exception()
 
     def run(self):
         if self.event_loop is None:
             self.event_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.event_loop)
         self.event_loop.run_until_complete(self._main())
+
+    def shutdown(self):
+        """关闭窗口时调用: 停止朗读, 关掉MoeGoe子程序和HTTP连接"""
+        self.stop()
+        self.wait()
+        if self.event_loop is not None:  # 没有事件循环就没开过MoeGoe和HTTP连接
+            self.event_loop.run_until_complete(self.synthesizer.close())
+
+
+async def _benchmark_online(n: int = 20, latency: float = 0.2, size: int = 200 << 10):
+    """
+    用本地的假接口比较 每句新建session串行下载 和 复用session并发下载 的耗时\n
+    假接口每个请求固定延迟latency秒, 返回size字节的数据
+    """
+    import tempfile
+    from time import perf_counter
+    from aiohttp import web
+
+    async def handler(request: web.Request):
+        await asyncio.sleep(latency)
+        return web.Response(body=b'\0' * size, content_type='audio/wav')
+
+    app = web.Application()
+    app.router.add_get('/generate', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    urls = [f'http://127.0.0.1:{port}/generate?text={i}' for i in range(n)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        t = perf_counter()
+        for i, url in enumerate(urls):  # 原来的做法
+            async with aiohttp.ClientSession() as session:
+                res = await session.get(url)
+                content = await res.read()
+            with open(os.path.join(tmp_dir, f'a{i}.wav'), 'wb') as file:
+                file.write(content)
+        print(f'串行, 每句新建session: {perf_counter() - t:.3f}s')
+
+        for concurrency in (1, 3, 5):
+            downloader = Downloader(concurrency=concurrency)
+            t = perf_counter()
+            await asyncio.gather(*(downloader.download(url, os.path.join(tmp_dir, f'b{i}.wav')) for i, url in enumerate(urls)))
+            print(f'复用session, 并发{concurrency}: {perf_counter() - t:.3f}s')
+            await downloader.close()
+    await runner.cleanup()
+
+
+def _prerender_cli(path: str, start: int = 0, end: Optional[int] = None):
+    """命令行里预先合成第start到第end-1章(默认到最后一章)"""
+    with epub.Epub(path) as book:
+        end = len(book.navs) if end is None else min(end, len(book.navs))
+
+    def progress(done: int, total: int):
+        print(f'\r预先合成: {done}/{total}', end='', flush=True)
+
+    async def main():
+        synthesizer = Synthesizer()
+        try:
+            return await prerender(path, range(start, end), synthesizer, progress)
+        finally:
+            await synthesizer.close()
+
+    done, total = asyncio.run(main())
+    print(f'\n完成{done}/{total}段, {AudioCache()}')
+
+
+if __name__ == '__main__':
+    # python speak.py                          用本地的假接口测在线合成的下载速度
+    # python speak.py 书的路径 [起始章节] [结束章节]  把这些章节预先合成到音频缓存(章节从0开始, 不含结束章节)
+    if len(sys.argv) > 1:
+        _prerender_cli(sys.argv[1], *(int(arg) for arg in sys.argv[2:4]))
+    else:
+        asyncio.run(_benchmark_online())
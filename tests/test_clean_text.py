@@ -0,0 +1,140 @@
+import random
+from typing import List
+
+import pytest
+
+from utils import clean_text, clean_text_multilingual, clean_text_simple, printable_set, whitespace_set
+
+
+def clean_text_simple_loop(text: str) -> str:
+    """`clean_text_simple`原来的逐字实现, 用来对照"""
+    text = text.strip()
+    lst: List[str] = ['[ZH]']
+    for ch in text:
+        if ch in whitespace_set:
+            lst.append('。')
+        else:
+            lst.append(ch)
+            if 'a' <= ch <= 'z' or 'A' <= ch <= 'Z':
+                lst.append('，')
+    lst.append('[ZH]')
+    return ''.join(lst)
+
+
+def clean_text_loop(text: str) -> str:
+    """`clean_text`原来的逐字实现(原样保留), 用来对照"""
+    text = text.strip()
+    lst: List[str] = []
+    en_mode = False
+    for ch in text:
+        if not en_mode:
+            if 'a' <= ch <= 'z' or 'A' <= ch <= 'Z':  # 进入英文模式
+                en_mode = True
+                if lst:
+                    lst.append('[ZH]')  # 中文结束
+                lst.append('[EN]')  # 英文开始
+                if ch in whitespace_set:
+                    ch = '. '
+                lst.append(ch)
+            else:  # 保持中文模式
+                if not lst:
+                    lst.append('[ZH]')  # 中文开始
+                if ch in whitespace_set:
+                    ch = '。'
+                lst.append(ch)
+        else:
+            if ch not in printable_set:  # 进入中文模式
+                en_mode = False
+                lst.append('[EN]')  # 英文结束
+                lst.append('[ZH]')  # 中文开始
+                if ch in whitespace_set:
+                    ch = '。'
+                lst.append(ch)
+            else:  # 保持英文模式
+                if ch != ' ' and ch in whitespace_set:
+                    ch = '. '
+                lst.append(ch)
+    if lst:
+        lst.append('[EN]' if en_mode else '[ZH]')
+    return ''.join(lst)
+
+
+def corpus() -> List[str]:
+    """手写的典型段落 + 固定种子随机拼出来的各种字符组合"""
+    texts = [
+        '',
+        '   ',
+        '假面骑士的末日到了',
+        '你是世界首例感染Bugster病毒的男人啊！',
+        '  开头和结尾的空白\n',
+        'Hello, world!\tTabs\nand newlines\r\n混在一起',
+        '「这是什么？」他问道。　　“不知道……”',
+        'ABC中文DEF\x0b\x0c结束',
+        '第1章 Chapter One 开始了',
+        'a',
+        '中',
+    ]
+    pool = 'abcXYZ019 \t\n\r\x0b\x0c,.!?-\'"中文字，。！？「」…　あカ한'
+    rng = random.Random(20240601)
+    texts += [''.join(rng.choice(pool) for _ in range(rng.randint(0, 40))) for _ in range(5000)]
+    return texts
+
+
+@pytest.mark.parametrize('new, old', [(clean_text_simple, clean_text_simple_loop), (clean_text, clean_text_loop)])
+def test_same_output_as_loop(new, old):
+    for text in corpus():
+        assert new(text) == old(text), repr(text)
+
+
+def test_docstring_examples():
+    assert clean_text_simple('假面骑士的末日到了') == '[ZH]假面骑士的末日到了[ZH]'
+    assert clean_text_simple('你是世界首例感染Bugster病毒的男人啊！') == '[ZH]你是世界首例感染B，u，g，s，t，e，r，病毒的男人啊！[ZH]'
+    assert clean_text('你是世界首例感染Bugster病毒的男人啊！') == '[ZH]你是世界首例感染[ZH][EN]Bugster[EN][ZH]病毒的男人啊！[ZH]'
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('他回答：そうですね。', '[ZH]他回答：[ZH][JA]そうですね。[JA]'),
+    ('日本語の本を読む', '[ZH]日本語[ZH][JA]の本を読む[JA]'),  # 假名之前的汉字归中文
+    ('東京に行きました。\n次は大阪', '[ZH]東京[ZH][JA]に行きました。[JA][ZH]。次[ZH][JA]は大阪[JA]'),
+    ('안녕하세요 세계!', '[KO]안녕하세요 세계![KO]'),
+    ('사랑해요\n고마워', '[KO]사랑해요. 고마워[KO]'),  # 韩文按英文的方式处理空白
+    ('ハングル한국어 2024년', '[JA]ハングル[JA][KO]한국어 2024년[KO]'),
+    ('我说 hello world 然后走了', '[ZH]我说。[ZH][EN]hello world [EN][ZH]然后走了[ZH]'),
+    ('', ''),
+])
+def test_multilingual(text, expected):
+    assert clean_text_multilingual(text) == expected
+
+
+def test_multilingual_without_ja_ko_matches_clean_text():
+    for text in corpus():
+        if not any('\u3040' <= ch <= '\u30ff' or '\uac00' <= ch <= '\ud7af' for ch in text):  # 没有假名和谚文
+            assert clean_text_multilingual(text) == clean_text(text), repr(text)
+
+
+def benchmark(path: str):
+    """用一整本书的文字对照新旧实现的输出是否一致, 并比较耗时"""
+    from time import perf_counter
+    import epub
+    with epub.Epub(path) as book:
+        texts = [item.text for idx in range(len(book.navs)) for item in book.iter_content(idx, cache=False) if type(item) is epub.Text]
+    for name, new, old in (('clean_text_simple', clean_text_simple, clean_text_simple_loop), ('clean_text', clean_text, clean_text_loop)):
+        diffs = sum(new(text) != old(text) for text in texts)
+        t = perf_counter()
+        for text in texts:
+            old(text)
+        old_time = perf_counter() - t
+        t = perf_counter()
+        for text in texts:
+            new(text)
+        new_time = perf_counter() - t
+        print(f'{name}: {len(texts)}段, 不一致{diffs}段, 逐字 {old_time:.3f}s, 查表 {new_time:.3f}s, {old_time / new_time:.1f}倍')
+
+
+if __name__ == '__main__':
+    # 在仓库根目录运行: python -m tests.test_clean_text 书的路径
+    import sys
+    if len(sys.argv) < 2:
+        print('用法: python -m tests.test_clean_text 书的路径')
+        sys.exit(1)
+    benchmark(sys.argv[1])
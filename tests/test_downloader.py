@@ -0,0 +1,217 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from speak import Downloader
+
+
+@asynccontextmanager
+async def stub_server(handler):
+    """本地的假接口, 产出它的url"""
+    app = web.Application()
+    app.router.add_get('/generate', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    try:
+        yield f'http://{host}:{port}/generate'
+    finally:
+        await runner.cleanup()
+
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if name.endswith('.part')]
+
+
+def test_keep_alive_reuse(tmp_path):
+    peers = []
+
+    async def handler(request):
+        peers.append(request.transport.get_extra_info('peername'))
+        return web.Response(body=b'RIFF' + b'\0' * 100)
+
+    async def main():
+        downloader = Downloader(concurrency=1)
+        async with stub_server(handler) as url:
+            for i in range(5):
+                await downloader.download(f'{url}?text={i}', str(tmp_path / f'{i}.wav'))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert len(peers) == 5
+    assert len(set(peers)) == 1  # 同一个连接
+
+
+def test_concurrency_bound(tmp_path):
+    active = peak = 0
+
+    async def handler(request):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+        return web.Response(body=b'data')
+
+    async def main():
+        downloader = Downloader(concurrency=2)
+        async with stub_server(handler) as url:
+            await asyncio.gather(*(downloader.download(f'{url}?text={i}', str(tmp_path / f'{i}.wav')) for i in range(8)))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert peak == 2
+    assert len(list(tmp_path.glob('*.wav'))) == 8
+
+
+def test_streamed_body_written_to_disk(tmp_path):
+    body = bytes(range(256)) * 1024  # 比Downloader.chunk_size大, 要分好几块写
+
+    async def handler(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for start in range(0, len(body), 10000):
+            await response.write(body[start: start + 10000])
+        await response.write_eof()
+        return response
+
+    async def main():
+        downloader = Downloader()
+        async with stub_server(handler) as url:
+            await downloader.download(url, str(tmp_path / 'a.wav'))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert (tmp_path / 'a.wav').read_bytes() == body
+    assert not leftovers(tmp_path)
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retry_on_server_error(tmp_path, status):
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            return web.Response(status=status)
+        return web.Response(body=b'ok')
+
+    async def main():
+        downloader = Downloader(retries=2)
+        async with stub_server(handler) as url:
+            await downloader.download(url, str(tmp_path / 'a.wav'))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert calls == 3
+    assert (tmp_path / 'a.wav').read_bytes() == b'ok'
+
+
+def test_no_retry_on_client_error(tmp_path):
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        return web.Response(status=404)
+
+    async def main():
+        downloader = Downloader(retries=3)
+        async with stub_server(handler) as url:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await downloader.download(url, str(tmp_path / 'a.wav'))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert calls == 1
+    assert not os.listdir(tmp_path)
+
+
+def test_timeout_then_retry(tmp_path):
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(1)
+        return web.Response(body=b'ok')
+
+    async def main():
+        downloader = Downloader(timeout=0.2, retries=1)
+        async with stub_server(handler) as url:
+            await downloader.download(url, str(tmp_path / 'a.wav'))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert calls == 2
+    assert (tmp_path / 'a.wav').read_bytes() == b'ok'
+
+
+def test_timeout_gives_up(tmp_path):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return web.Response(body=b'ok')
+
+    async def main():
+        downloader = Downloader(timeout=0.2, retries=0)
+        async with stub_server(handler) as url:
+            with pytest.raises(asyncio.TimeoutError):
+                await downloader.download(url, str(tmp_path / 'a.wav'))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert not os.listdir(tmp_path)
+
+
+def test_cleanup_on_cancel(tmp_path):
+    started = None
+
+    async def handler(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(b'\0' * 1000)
+        started.set()
+        await asyncio.sleep(1)  # 剩下的迟迟不来
+        return response
+
+    async def main():
+        nonlocal started
+        started = asyncio.Event()
+        downloader = Downloader()
+        async with stub_server(handler) as url:
+            task = asyncio.ensure_future(downloader.download(url, str(tmp_path / 'a.wav')))
+            await started.wait()
+            await asyncio.sleep(0.05)  # 让下载写进.part
+            assert leftovers(tmp_path)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        await downloader.close()
+
+    asyncio.run(main())
+    assert not os.listdir(tmp_path)
+
+
+def test_same_path_concurrently(tmp_path):
+    """朗读和预先合成可能同时下载同一段, 各自的临时文件不会互相干扰"""
+    async def handler(request):
+        await asyncio.sleep(0.05)
+        return web.Response(body=b'same')
+
+    async def main():
+        downloader = Downloader(concurrency=3)
+        async with stub_server(handler) as url:
+            await asyncio.gather(*(downloader.download(url, str(tmp_path / 'a.wav')) for _ in range(3)))
+        await downloader.close()
+
+    asyncio.run(main())
+    assert os.listdir(tmp_path) == ['a.wav']
+    assert (tmp_path / 'a.wav').read_bytes() == b'same'
@@ -0,0 +1,71 @@
+import zipfile
+
+import pytest
+
+import epub
+
+
+def xhtml(body):
+    return ('<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<head><title>t</title></head><body>{body}</body></html>')
+
+
+@pytest.fixture
+def make_book(tmp_path, monkeypatch):
+    """用 {文件名: body} 和目录 [(标题, href)] 拼一本最简单的EPUB3, spine按files的顺序"""
+    monkeypatch.setattr(epub, 'book_index', epub.BookIndex(str(tmp_path / 'cache')))
+    books = []
+
+    def make(files, toc):
+        path = tmp_path / f'{len(books)}.epub'
+        items = ''.join(f'<item id="f{i}" href="{name}" media-type="application/xhtml+xml"/>' for i, name in enumerate(files))
+        refs = ''.join(f'<itemref idref="f{i}"/>' for i in range(len(files)))
+        links = ''.join(f'<li><a href="{href}">{title}</a></li>' for title, href in toc)
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('mimetype', 'application/epub+zip')
+            z.writestr('META-INF/container.xml', '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                       '<rootfiles><rootfile full-path="OPS/package.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+            z.writestr('OPS/package.opf', '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0"><manifest>'
+                       f'<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>{items}</manifest><spine>{refs}</spine></package>')
+            z.writestr('OPS/nav.xhtml', xhtml(f'<nav epub:type="toc"><ol>{links}</ol></nav>'))
+            for name, body in files.items():
+                z.writestr(f'OPS/{name}', xhtml(body))
+        book = epub.Epub(str(path))
+        books.append(book)
+        return book
+
+    yield make
+    for book in books:
+        book.close()
+
+
+def texts(book, nav_id):
+    return [item.text for item in book.get_content(nav_id) if type(item) is epub.Text]
+
+
+def test_first_entry_with_fragment_starts_at_file_beginning(make_book):
+    book = make_book({'c1.xhtml': '<h1 id="c1">第一章</h1><p>一</p><h1 id="c2">第二章</h1><p>二</p>'},
+                     [('第一章', 'c1.xhtml#c1'), ('第二章', 'c1.xhtml#c2')])
+    assert [nav.text for nav in book.navs] == ['第一章', '第二章']
+    assert texts(book, 0) == ['第一章', '一']
+    assert texts(book, 1) == ['第二章', '二']
+
+
+def test_content_before_first_fragment_is_kept(make_book):
+    book = make_book({'c1.xhtml': '<p>题记</p><h1 id="c1">第一章</h1><p>一</p>'}, [('第一章', 'c1.xhtml#c1')])
+    assert [nav.text for nav in book.navs] == ['第一章']
+    assert texts(book, 0) == ['题记', '第一章', '一']
+
+
+def test_cover_outside_toc_gets_its_own_entry(make_book):
+    book = make_book({'cover.xhtml': '<p>封面</p>', 'c1.xhtml': '<h1 id="c1">第一章</h1><p>一</p>'}, [('第一章', 'c1.xhtml#c1')])
+    assert [nav.text for nav in book.navs] == ['开头', '第一章']
+    assert texts(book, 0) == ['封面']
+    assert texts(book, 1) == ['第一章', '一']
+
+
+def test_first_file_targeted_without_fragment(make_book):
+    book = make_book({'c1.xhtml': '<h1>第一章</h1><p>一</p><h2 id="s">一节</h2><p>节</p>'},
+                     [('第一章', 'c1.xhtml'), ('一节', 'c1.xhtml#s')])
+    assert [nav.src for nav in book.navs] == ['OPS/c1.xhtml', 'OPS/c1.xhtml#s']
+    assert texts(book, 0) == ['第一章', '一']
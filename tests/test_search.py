@@ -0,0 +1,104 @@
+import pytest
+
+import epub
+from search import SearchIndex
+
+
+@pytest.fixture
+def index():
+    return SearchIndex([
+        (0, 0, '甲乙丙丁'),
+        (0, 1, '乙丙'),
+        (1, 0, '丙丁甲乙'),
+        (1, 2, 'ABxBC'),
+        (2, 0, 'Hello World'),
+    ])
+
+
+def positions(hits):
+    return [(nav_id, item_id) for nav_id, item_id, _ in hits]
+
+
+def test_bigram_intersection(index):
+    assert positions(index.search('乙丙')) == [(0, 0), (0, 1)]
+    assert positions(index.search('甲乙丙')) == [(0, 0)]
+    assert index.search('丙甲') == []
+
+
+def test_bigrams_present_but_not_adjacent(index):
+    """AB和BC都在, 但连起来的ABC不在"""
+    assert index.search('ABC') == []
+
+
+def test_single_character(index):
+    assert positions(index.search('丁')) == [(0, 0), (1, 0)]
+    assert positions(index.search('x')) == [(1, 2)]
+
+
+def test_case_folding(index):
+    assert positions(index.search('hello')) == [(2, 0)]
+    assert positions(index.search('WORLD')) == [(2, 0)]
+    assert positions(index.search('abx')) == [(1, 2)]
+
+
+def test_empty_query_and_limit(index):
+    assert index.search('') == []
+    assert index.search('   ') == []
+    assert len(index.search('丙', limit=2)) == 2
+
+
+def test_snippet():
+    text = '前' * 30 + '关键词' + '后' * 30
+    (_, _, snippet), = SearchIndex([(0, 0, text)]).search('关键词')
+    assert snippet == '...' + '前' * SearchIndex.snippet_len + '关键词' + '后' * SearchIndex.snippet_len + '...'
+    (_, _, snippet), = SearchIndex([(0, 0, '短句里的关键词')]).search('关键词')
+    assert snippet == '短句里的关键词'
+
+
+@pytest.fixture
+def book(tmp_path, monkeypatch):
+    monkeypatch.setattr(epub, 'book_index', epub.BookIndex(str(tmp_path / 'cache')))
+    path = tmp_path / 'book.txt'
+    path.write_text('第一章 开始\n他走进了房间。\n房间里没有人。\n第二章 结束\n他离开了房间。\n', encoding='utf-8')
+    with epub.Epub(str(path)) as book:
+        yield book
+
+
+def test_build_from_book(book):
+    index = SearchIndex.build(book)
+    hits = index.search('房间')
+    assert [book.get_content(nav_id)[item_id].text for nav_id, item_id, _ in hits] == ['他走进了房间。', '房间里没有人。', '他离开了房间。']
+    assert {nav_id for nav_id, _, _ in hits} == {0, 1}
+
+
+def test_build_can_stop(book):
+    assert SearchIndex.build(book, lambda: True) is None
+    assert SearchIndex.load_or_build(book, lambda: True) is None
+    assert epub.book_index.load(book.epub_path, 'search') is None  # 没建完的不保存
+
+
+def test_load_saved_index(book, monkeypatch):
+    built = SearchIndex.load_or_build(book)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('索引已经保存过, 不应该重新建立')
+
+    monkeypatch.setattr(SearchIndex, 'build', staticmethod(fail))
+    loaded = SearchIndex.load_or_build(book)
+    assert loaded.docs == built.docs
+    assert loaded.search('房间') == built.search('房间')
+
+
+def test_version_change_rebuilds(book, monkeypatch):
+    SearchIndex.load_or_build(book)
+    calls = []
+    build = SearchIndex.build
+
+    def counting_build(*args, **kwargs):
+        calls.append(1)
+        return build(*args, **kwargs)
+
+    monkeypatch.setattr(SearchIndex, 'build', staticmethod(counting_build))
+    monkeypatch.setattr(SearchIndex, 'version', SearchIndex.version + 1)
+    assert SearchIndex.load_or_build(book).search('房间')
+    assert calls == [1]
@@ -0,0 +1,57 @@
+import pytest
+
+from utils import split_long_text
+
+
+def check(text, max_len, hard_max):
+    """通用的约束: 拼回去和原文一样, 没有空段, 每段不超过hard_max"""
+    pieces = list(split_long_text(text, max_len, hard_max))
+    assert ''.join(pieces) == text
+    assert all(pieces)
+    assert all(len(piece) <= max(hard_max, max_len, 2) for piece in pieces)
+    return pieces
+
+
+def test_short_text_unchanged():
+    assert list(split_long_text('短句。', 25, 60)) == ['短句。']
+    assert list(split_long_text('', 25, 60)) == ['']
+
+
+def test_cut_after_punctuation():
+    text = '一' * 30 + '，' + '二' * 30 + '。' + '三' * 10
+    assert check(text, 25, 60) == ['一' * 30 + '，', '二' * 30 + '。', '三' * 10]
+
+
+def test_punctuation_run_at_boundary():
+    """连着的几个标点算一处, 不会从中间切开"""
+    text = '一' * 24 + '。！？' + '二' * 10
+    assert check(text, 25, 60) == ['一' * 24 + '。！？', '二' * 10]
+
+
+def test_no_punctuation_balanced_cut():
+    """找不到标点也找不到空白时强行切开, 各段长度差不多"""
+    pieces = check('字' * 130, 25, 60)
+    assert [len(piece) for piece in pieces] == [44, 43, 43]
+
+
+def test_forced_cut_before_punctuation():
+    pieces = check('字' * 100 + '。' + '尾' * 5, 25, 60)
+    assert pieces[-1] == '尾' * 5
+    lengths = [len(piece) for piece in pieces[:-1]]
+    assert max(lengths) - min(lengths) <= 1
+
+
+def test_whitespace_fallback():
+    pieces = check('word ' * 30, 25, 60)
+    assert all(piece.endswith(' ') for piece in pieces)
+
+
+def test_only_whitespace():
+    check(' ' * 100, 25, 60)
+    check('\n' * 7, 2, 3)
+
+
+@pytest.mark.parametrize('max_len, hard_max', [(1, 1), (0, 0), (-5, 1), (2, 1), (1, 3)])
+def test_tiny_limits_terminate(max_len, hard_max):
+    for text in ['。。ab。cd', 'abcdef', '   x  ', '。' * 9, 'a。b。c。']:
+        check(text, max_len, hard_max)
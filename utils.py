@@ -1,6 +1,8 @@
+from bisect import bisect_left, bisect_right
 import os
+import re
 from string import printable, whitespace
-from typing import List, Type, Optional, Generator
+from typing import Dict, List, Type, Optional, Generator, Tuple
 
 from PySide2.QtWidgets import QWidget, QScrollArea, QFormLayout
 from PySide2.QtGui import QDragEnterEvent, QDropEvent
@@ -29,6 +31,10 @@ def singleton(cls: Type):
     return _singleton
 
 
+_whitespace_re = re.compile('[\t-\r ]')  # string.whitespace
+_letters_re = re.compile('[A-Za-z]+')
+
+
 def clean_text_simple(text: str) -> str:
     """
     为了给MoeGoe使用，需要对文本进行简单处理，即用语言标签包裹起来。\n
@@ -37,80 +43,122 @@ def clean_text_simple(text: str) -> str:
     - e.g. '你是世界首例感染Bugster病毒的男人啊！' => '[ZH]你是世界首例感染B，u，g，s，t，e，r，病毒的男人啊！[ZH]'
     """
     text = text.strip()
-    lst: List[str] = ['[ZH]']
-    for ch in text:
-        if ch in whitespace_set:
-            lst.append('。')
-        else:
-            lst.append(ch)
-            if 'a' <= ch <= 'z' or 'A' <= ch <= 'Z':
-                lst.append('，')
-    lst.append('[ZH]')
-    return ''.join(lst)
+    if _whitespace_re.search(text):  # 先查一遍再替换, 大部分段落里根本没有这些字符
+        text = _whitespace_re.sub('。', text)
+    if _letters_re.search(text):
+        text = _letters_re.sub(lambda match: '，'.join(match.group()) + '，', text)
+    return f'[ZH]{text}[ZH]'
+
 
+class Translator:
+    """编译好的替换表, 文本里有需要替换的字符时才调用str.translate"""
+    def __init__(self, table: Dict[str, str]) -> None:
+        self.table = str.maketrans(table)
+        self.pattern = re.compile(f'[{re.escape("".join(table))}]') if table else None
 
-def clean_text(text: str) -> str:
+    def __call__(self, text: str) -> str:
+        if self.pattern is not None and self.pattern.search(text):
+            return text.translate(self.table)
+        return text
+
+
+class TextCleaner:
     """
+    表驱动的语言标签处理: 每种语言用 "片段开头的字符" 和 "片段中可以延续的字符" 两个字符类描述,
+    合成一个正则一次切出所有片段, 剩下的部分归入默认语言; 每种语言有自己的空白替换表\n
+    要支持新的语言, 在languages里按优先级加一项 (标签, 开头字符类, 延续字符类, 替换表) 即可
+    """
+    def __init__(self, default: str, default_table: Translator, languages: List[Tuple[str, str, str, Translator]]) -> None:
+        self.default = default
+        self.default_table = default_table
+        self.tables = {tag: table for tag, _, _, table in languages}
+        self.pattern = re.compile('|'.join(f'(?P<{tag}>[{start}][{cont}]*)' for tag, start, cont, _ in languages))
+
+    def __call__(self, text: str) -> str:
+        text = text.strip()
+        if not text:
+            return ''
+        default = self.default
+        match = self.pattern.search(text)
+        if match is None:  # 最常见的情况: 整段都是默认语言
+            return f'[{default}]{self.default_table(text)}[{default}]'
+        parts: List[str] = []
+        pos = 0
+        while match is not None:
+            if match.start() > pos:
+                parts.append(f'[{default}]{self.default_table(text[pos:match.start()])}[{default}]')
+            tag = match.lastgroup
+            parts.append(f'[{tag}]{self.tables[tag](match.group())}[{tag}]')
+            pos = match.end()
+            match = self.pattern.search(text, pos)
+        if pos < len(text):
+            parts.append(f'[{default}]{self.default_table(text[pos:])}[{default}]')
+        return ''.join(parts)
+
+
+_zh_table = Translator({ch: '。' for ch in whitespace})
+_en_table = Translator({ch: '. ' for ch in whitespace if ch != ' '})
+_en = ('EN', 'A-Za-z', r'\t-\r -~', _en_table)  # 以字母开头, 一直延续到不可打印的(非ASCII)字符为止
+_kana = '\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f'
+_hangul = '\uac00-\ud7af\u1100-\u11ff\u3130-\u318f'
+_ja = ('JA', _kana, _kana + '\u4e00-\u9fff\u3000-\u303f\uff01-\uff0f', _zh_table)  # 以假名开头, 汉字和日文标点也算进去
+_ko = ('KO', _hangul, _hangul + r'\t-\r -@\[-`{-~', _en_table)  # 以谚文开头, 空格、数字和ASCII标点也算进去
+
+clean_text = TextCleaner('ZH', _zh_table, [_en])
+clean_text.__doc__ = """
     为了给MoeGoe使用，需要对文本进行简单处理，即用语言标签包裹起来。\n
     目前只支持中文(ZH)和英文(EN)，对换行等符号的处理是一律转成句号。
     - e.g. '假面骑士的末日到了' => '[ZH]假面骑士的末日到了[ZH]'
     - e.g. '你是世界首例感染Bugster病毒的男人啊！' => '[ZH]你是世界首例感染[ZH][EN]Bugster[EN][ZH]病毒的男人啊！[ZH]'
     """
-    text = text.strip()
-    lst: List[str] = []
-    en_mode = False
-    for ch in text:
-        if not en_mode:
-            if 'a' <= ch <= 'z' or 'A' <= ch <= 'Z':  # 进入英文模式
-                en_mode = True
-                if lst:
-                    lst.append('[ZH]')  # 中文结束
-                lst.append('[EN]')  # 英文开始
-                if ch in whitespace_set:
-                    ch = '. '
-                lst.append(ch)
-            else:  # 保持中文模式
-                if not lst:
-                    lst.append('[ZH]')  # 中文开始
-                if ch in whitespace_set:
-                    ch = '。'
-                lst.append(ch)
-        else:
-            if ch not in printable_set:  # 进入中文模式
-                en_mode = False
-                lst.append('[EN]')  # 英文结束
-                lst.append('[ZH]')  # 中文开始
-                if ch in whitespace_set:
-                    ch = '。'
-                lst.append(ch)
-            else:  # 保持英文模式
-                if ch != ' ' and ch in whitespace_set:
-                    ch = '. '
-                lst.append(ch)
-    if lst:
-        lst.append('[EN]' if en_mode else '[ZH]')
-    return ''.join(lst)
-
-
-def split_long_text(text: str, max_len: int = 25) -> Generator[str, None, None]:
+clean_text_multilingual = TextCleaner('ZH', _zh_table, [_en, _ja, _ko])
+clean_text_multilingual.__doc__ = """
+    在`clean_text`的基础上再区分日文(JA)和韩文(KO), 模型支持这些标签时使用\n
+    日文片段从假名开始, 之后的汉字和日文标点也算日文(之前的汉字仍会归入中文); 韩文片段从谚文开始
+    - e.g. '他回答：そうですね。' => '[ZH]他回答：[ZH][JA]そうですね。[JA]'
     """
-    若文本长度超过最大长度，则从这里开始往后寻找最近的标点符号(比如句号)，进行分割
+
+
+_punctuation_re = re.compile(f'[{re.escape("".join(sorted(punctuation_set)))}]+')
+
+
+def split_long_text(text: str, max_len: int = 25, hard_max: int = 60) -> Generator[str, None, None]:
+    """
+    若文本长度超过最大长度，则从这里开始往后寻找最近的标点符号(比如句号，连着的几个标点算一处)，进行分割，但每段最长不超过hard_max\n
+    hard_max之内找不到时，依次退而求其次: max_len之内最后一个标点 => hard_max之内最后一个空白 => 强行切开(把到下一个标点为止的这一串平均分成几段)\n
+    所有可以切的位置都在开头扫描一遍得到，之后只做二分查找; max_len最小按2算(这两个值来自config.json)
     """
+    max_len = max(max_len, 2)
     length = len(text)
     if length <= max_len:  # 不需要分割
         yield text
-    else:
-        start = 0
-        while start < length:
-            end = start + max_len
-            if end >= length:  # 分完了
-                yield text[start:]
-                break
-            else:  # 还没分完
-                while end < length and text[end - 1] not in punctuation_set:
-                    end += 1  # 向后找最近的标点符号, 但是不能超过总长度
-                yield text[start: end]  # 分割
-                start = end
+        return
+    hard_max = max(hard_max, max_len)
+    min_len = max_len // 2  # 退而求其次时, 比这还短的一段不要
+    puncts = [match.end() for match in _punctuation_re.finditer(text)]  # 在这些位置切, 标点留在前一段
+    spaces = [match.end() for match in _whitespace_re.finditer(text)]
+    start = 0
+    while start < length:
+        if length - start <= max_len:  # 分完了
+            yield text[start:]
+            break
+        idx = bisect_left(puncts, start + max_len)  # max_len之后最近的标点
+        if idx < len(puncts) and puncts[idx] - start <= hard_max:
+            end = puncts[idx]
+        elif idx == len(puncts) and length - start <= hard_max:  # 后面没有标点了, 剩下的也不算长
+            end = length
+        elif idx > 0 and puncts[idx - 1] - start >= min_len:  # max_len之内最后一个标点, 太靠前的不要
+            end = puncts[idx - 1]
+        else:
+            space_idx = bisect_right(spaces, start + hard_max) - 1
+            if space_idx >= 0 and spaces[space_idx] - start >= min_len:
+                end = spaces[space_idx]
+            else:  # 强行切开, 把到下一个标点为止的这一串平均分, 免得最后剩下很短的一截
+                run = (puncts[idx] if idx < len(puncts) else length) - start
+                pieces = -(-run // hard_max)
+                end = start + -(-run // pieces)
+        yield text[start: end]  # 分割
+        start = end
 
 
 class ScrollArea(QScrollArea):
@@ -140,8 +188,11 @@ class ScrollArea(QScrollArea):
 
 class MediaPlayer(QMediaPlayer):
     def setMedia(self, path: str) -> None:
-        """很神奇,如果文件名相同的话它似乎就不会重新加载,所以一定要随机名称"""
-        return super().setMedia(QMediaContent(QUrl.fromLocalFile(path)))
+        """很神奇,如果文件名和当前的相同它就不会重新加载,所以遇到同一个文件(缓存的音频会反复播放)时先清空再设置"""
+        url = QUrl.fromLocalFile(path)
+        if self.media().canonicalUrl() == url:
+            super().setMedia(QMediaContent())
+        return super().setMedia(QMediaContent(url))
 
 
 class FileDragable(QWidget):